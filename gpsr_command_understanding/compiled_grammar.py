@@ -0,0 +1,392 @@
+import random
+from bisect import bisect_right
+from collections import deque
+from copy import deepcopy
+
+from lark import Tree
+
+from gpsr_command_understanding.grammar import expand_shorthand, normalize_expressions, check_annotation, \
+    count_reachable_derivations
+from gpsr_command_understanding.semantics import utterance_signature
+from gpsr_command_understanding.tokens import NonTerminal, WildCard, Anonymized
+
+
+class CompiledGrammar(object):
+    """
+    A compact, integer-coded form of a set of production rules and their semantics.
+
+    Every leaf (word, nonterminal, wildcard or anonymized token) becomes a symbol ID. Utterances are tuples of IDs
+    and each expandable symbol has a tuple of productions, each already flattened, void-free and choice-free.
+    Semantic templates become nested (data, children) tuples with IDs at the leaves, so they can be shared
+    between derivations instead of copied.
+    """
+    def __init__(self, production_rules, semantics_rules=None):
+        # Symbol table. symbols[i] is the original leaf object
+        self.symbols = []
+        self._ids = {}
+        self.is_placeholder = []
+        self.is_void = []
+        self.is_wildcard = []
+        self.is_anonymized = []
+
+        # productions[i] is None for symbols that can't be expanded
+        self.productions = []
+        for symbol in production_rules.keys():
+            self.symbol_id(symbol)
+        for symbol, rule_productions in production_rules.items():
+            compiled = []
+            for production in rule_productions:
+                compiled.extend(self.encode_production(production))
+            self.productions[self.symbol_id(symbol)] = tuple(compiled)
+
+        self.quote_id = self.symbol_id("\"")
+        # Flat utterance templates, as ID tuples, mapped to semantic templates
+        self.semantics = {}
+        self.semantics_utterances = {}
+        for utterance, semantics in (semantics_rules or {}).items():
+            signature = self.encode_utterance(utterance)
+            if signature is not None and signature not in self.semantics:
+                self.semantics[signature] = self.encode_semantics(semantics)
+                self.semantics_utterances[signature] = utterance
+        # Derivation counts by symbol ID, filled in as symbols are counted
+        self._counts = {}
+        self._weights = {}
+        self._templates = None
+
+    def symbol_id(self, symbol):
+        # Words may be lark Tokens or plain strings; they're equal (and share an ID) when their text is the same
+        symbol_id = self._ids.get(symbol)
+        if symbol_id is not None:
+            return symbol_id
+        symbol_id = len(self.symbols)
+        self._ids[symbol] = symbol_id
+        self.symbols.append(symbol)
+        self.is_placeholder.append(isinstance(symbol, NonTerminal))
+        self.is_wildcard.append(isinstance(symbol, WildCard))
+        self.is_anonymized.append(isinstance(symbol, Anonymized))
+        self.is_void.append(isinstance(symbol, (WildCard, Anonymized)) and symbol.name == "void")
+        self.productions.append(None)
+        return symbol_id
+
+    def encode_production(self, production):
+        """
+        :return: list of ID tuples. Rules that still have lazy choices in them turn into one tuple per combination
+        """
+        if any(True for _ in production.find_data("choice")):
+            alternatives = expand_shorthand(deepcopy(production))
+        else:
+            alternatives = [production]
+        encoded = []
+        for alternative in alternatives:
+            # Productions get spliced into flat utterances with their voids dropped, just as
+            # DiscardVoid and CombineExpressions would leave them
+            ids = [self.symbol_id(leaf) for leaf in alternative.scan_values(lambda x: True)]
+            encoded.append(tuple(i for i in ids if not self.is_void[i]))
+        return encoded
+
+    def encode_utterance(self, utterance):
+        """
+        :param utterance: a NonTerminal, list of symbols or flat expression Tree
+        :return: tuple of IDs, or None if the utterance isn't flat
+        """
+        leaves = self._leaves(utterance)
+        if leaves is None:
+            return None
+        return tuple(self.symbol_id(symbol) for symbol in leaves)
+
+    @staticmethod
+    def _leaves(utterance):
+        if isinstance(utterance, NonTerminal):
+            return [utterance]
+        if isinstance(utterance, list):
+            return utterance
+        return utterance_signature(utterance)
+
+    def encode_semantics(self, semantics):
+        if not isinstance(semantics, Tree):
+            return self.symbol_id(semantics)
+        return semantics.data, tuple(self.encode_semantics(child) for child in semantics.children)
+
+    def derivation_count(self, symbol):
+        """
+        Number of complete derivations of a symbol, computed bottom-up over the symbols it can reach and remembered.
+        A symbol that can't be expanded has exactly one. Counts are exact Python ints, so they don't overflow on large
+        categories.
+        :param symbol: symbol ID
+        """
+        return count_reachable_derivations(symbol, self._children, self._count_symbol, self._counts,
+                                           lambda i: self.symbols[i].to_human_readable())
+
+    def _children(self, symbol):
+        if self.productions[symbol] is None:
+            return ()
+        return set(i for production in self.productions[symbol] for i in production)
+
+    def _count_symbol(self, symbol):
+        # Everything the symbol's productions use has been counted already
+        if self.productions[symbol] is None:
+            return 1
+        return sum(self._product(production) for production in self.productions[symbol])
+
+    def _product(self, ids):
+        # Derivations of a sequence of symbols: every combination of derivations of each one
+        product = 1
+        for i in ids:
+            product *= self.derivation_count(i)
+        return product
+
+    def count_derivations(self, utterance):
+        """
+        :param utterance: a NonTerminal, list of symbols or flat expression Tree
+        :return: how many fully expanded sentences generate_sentences would produce from it, duplicates included
+        """
+        leaves = self._leaves(utterance)
+        if leaves is None:
+            raise ValueError("Can only count derivations of a nonterminal, a list of symbols or a flat expression")
+        # Symbols the grammar has never seen can't be expanded, so they have one derivation. Don't give them IDs
+        return self._product(i for i in map(self._ids.get, leaves) if i is not None)
+
+    def recognizes(self, utterance, start_symbol):
+        """
+        Checks whether generate_sentences would produce the utterance from the start symbol, without enumerating
+        anything. Costs time in the length of the utterance and the size of the grammar, not the size of its language.
+        :param utterance: a flat expression Tree or list of symbols
+        """
+        leaves = utterance if isinstance(utterance, list) else utterance_signature(utterance)
+        if leaves is None:
+            return False
+        # Words the grammar has never seen can't be in its language. Don't give them IDs
+        ids = tuple(self._ids.get(leaf) for leaf in leaves)
+        start = self._ids.get(start_symbol)
+        if None in ids or start is None:
+            return False
+        # The walk below would never finish on a recursive grammar. This raises instead
+        self.derivation_count(start)
+        return len(ids) in self._ends(start, 0, ids, {})
+
+    def _ends(self, symbol, start, ids, memo):
+        # Every position the symbol can derive ids[start:position] up to
+        key = (symbol, start)
+        ends = memo.get(key)
+        if ends is not None:
+            return ends
+        if self.productions[symbol] is None:
+            ends = {start + 1} if start < len(ids) and ids[start] == symbol else set()
+        else:
+            ends = set()
+            for production in self.productions[symbol]:
+                positions = {start}
+                for child in production:
+                    positions = set(end for position in positions for end in self._ends(child, position, ids, memo))
+                    if not positions:
+                        break
+                ends.update(positions)
+        memo[key] = ends
+        return ends
+
+    def semantics_counts(self):
+        """
+        :return: dict mapping the utterance of each semantics rule to how many pairs can be expanded from it
+        """
+        result = {}
+        for signature, utterance in self.semantics_utterances.items():
+            result[utterance] = self._product(signature)
+        return result
+
+    def decode_utterance(self, utterance):
+        return Tree("expression", [self.symbols[i] for i in utterance])
+
+    def decode_semantics(self, semantics):
+        if not isinstance(semantics, tuple):
+            return self.symbols[semantics]
+        data, children = semantics
+        return Tree(data, [self.decode_semantics(child) for child in children])
+
+    def substitute(self, semantics, symbol_id, replacement):
+        """
+        Replace every occurrence of the symbol in a semantic template. Only the nodes that contain it are rebuilt.
+        """
+        data, children = semantics
+        changed = False
+        new_children = []
+        for child in children:
+            if child == symbol_id:
+                new_children.append(replacement)
+                changed = True
+            elif isinstance(child, tuple):
+                new_child = self.substitute(child, symbol_id, replacement)
+                changed = changed or new_child is not child
+                new_children.append(new_child)
+            else:
+                new_children.append(child)
+        if not changed:
+            return semantics
+        return data, tuple(new_children)
+
+    def substitute_production(self, semantics, symbol_id, production):
+        # Wildcards and anonymized text go into the parse as quoted strings
+        if self.is_wildcard[symbol_id] or (production and self.is_anonymized[production[0]]):
+            replacement = ("expression", (self.quote_id,) + production + (self.quote_id,))
+        else:
+            replacement = ("expression", production)
+        return self.substitute(semantics, symbol_id, replacement)
+
+    def generate_sentence_parse_pairs(self, start_tree, start_semantics=None, yield_requires_semantics=True):
+        """
+        Same breadth-first pairing as generation.generate_sentence_parse_pairs with no random generator,
+        yielding equal (utterance, semantics) Trees in the same order.
+        """
+        start = self.encode_utterance(start_tree)
+        if start is None:
+            raise ValueError("Can only generate from a nonterminal, a list of symbols or a flat expression")
+        if start_semantics is not None:
+            start_semantics = self.encode_semantics(start_semantics)
+        for utterance, semantics in self.expand(start, start_semantics):
+            if semantics is None:
+                if yield_requires_semantics:
+                    continue
+                yield self.decode_utterance(utterance), None
+                continue
+            pair = self.finish_pair(utterance, semantics)
+            if pair:
+                yield pair
+
+    def expand(self, start, start_semantics=None):
+        """
+        Breadth-first expansion of the leftmost expandable symbol.
+        :return: generator of fully expanded (utterance IDs, encoded semantics or None)
+        """
+        productions = self.productions
+        is_void = self.is_void
+        semantics_rules = self.semantics
+
+        frontier = deque([(start, start_semantics)])
+        while frontier:
+            utterance, semantics = frontier.popleft()
+            if semantics is None:
+                semantics = semantics_rules.get(utterance)
+            for i, symbol in enumerate(utterance):
+                if productions[symbol] is not None:
+                    break
+            else:
+                yield utterance, semantics
+                continue
+
+            prefix, suffix = utterance[:i], utterance[i + 1:]
+            if any(is_void[s] for s in prefix) or any(is_void[s] for s in suffix):
+                # Only the start of a derivation can still carry voids
+                prefix = tuple(s for s in prefix if not is_void[s])
+                suffix = tuple(s for s in suffix if not is_void[s])
+            for production in productions[symbol]:
+                new_semantics = None
+                if semantics is not None:
+                    new_semantics = self.substitute_production(semantics, symbol, production)
+                frontier.append((prefix + production + suffix, new_semantics))
+
+    def sample_pairs(self, random_generator=None):
+        """
+        An endless stream of pairs drawn uniformly at random from everything expand_all_semantics would produce
+        (duplicates weighted by how many derivations produce them). Each sample costs one derivation, and nothing
+        is kept between samples.
+        :param random_generator: a random.Random to draw from. A fresh one is used if none is given
+        """
+        random_generator = random_generator or random.Random()
+        total = self.pair_count()
+        if not total:
+            return
+        while True:
+            pair = self.pair_at(random_generator.randrange(total))
+            if pair:
+                yield pair
+
+    def pair_count(self):
+        """
+        :return: how many pairs expand_all_semantics would produce, duplicates included
+        """
+        cumulative = self._pair_templates()[1]
+        return cumulative[-1] if cumulative else 0
+
+    def pair_at(self, index):
+        """
+        Unrank a pair: maps each index in [0, pair_count()) to a different derivation, without expanding any of
+        the others. Costs one derivation.
+        :return: (utterance, semantics) Trees, or None if the derivation's annotation is broken
+        """
+        templates, cumulative = self._pair_templates()
+        if not 0 <= index < (cumulative[-1] if cumulative else 0):
+            raise IndexError("Pair index {} out of range".format(index))
+        template = bisect_right(cumulative, index)
+        if template:
+            index -= cumulative[template - 1]
+        utterance, semantics = templates[template]
+        productions = self.productions
+        # Which derivation of each symbol in the utterance to take
+        ranks = self._split_rank(index, utterance)
+        while True:
+            for i, symbol in enumerate(utterance):
+                if productions[symbol] is not None:
+                    break
+            else:
+                break
+            weights = self._production_weights(symbol)
+            choice = bisect_right(weights, ranks[i])
+            rank = ranks[i] - weights[choice - 1] if choice else ranks[i]
+            production = productions[symbol][choice]
+            utterance = utterance[:i] + production + utterance[i + 1:]
+            ranks = ranks[:i] + self._split_rank(rank, production) + ranks[i + 1:]
+            semantics = self.substitute_production(semantics, symbol, production)
+        return self.finish_pair(utterance, semantics)
+
+    def _pair_templates(self):
+        """
+        :return: (list of (utterance IDs, encoded semantics) for the semantics rules that expand to anything,
+            cumulative pair counts of those templates)
+        """
+        if self._templates is not None:
+            return self._templates
+        templates = []
+        cumulative = []
+        total = 0
+        for signature, semantics in self.semantics.items():
+            count = self._product(signature)
+            if count:
+                total += count
+                if any(self.productions[i] is not None for i in signature):
+                    # The first expansion drops any voids in the template
+                    signature = tuple(i for i in signature if not self.is_void[i])
+                templates.append((signature, semantics))
+                cumulative.append(total)
+        self._templates = templates, cumulative
+        return self._templates
+
+    def _split_rank(self, rank, utterance):
+        # Mixed radix over the symbols' derivation counts, most significant first
+        ranks = [0] * len(utterance)
+        for i in range(len(utterance) - 1, -1, -1):
+            rank, ranks[i] = divmod(rank, self.derivation_count(utterance[i]))
+        return ranks
+
+    def _production_weights(self, symbol):
+        # Cumulative derivation counts of the symbol's productions, for picking one by rank
+        weights = self._weights.get(symbol)
+        if weights is not None:
+            return weights
+        weights = []
+        total = 0
+        for production in self.productions[symbol]:
+            total += self._product(production)
+            weights.append(total)
+        self._weights[symbol] = weights
+        return weights
+
+    def finish_pair(self, utterance, semantics):
+        """
+        Decode a finished derivation and run the same annotation checks as generate_sentence_parse_pairs
+        :return: (utterance, semantics) Trees, or None if the annotation is broken
+        """
+        sentence = self.decode_utterance(utterance)
+        semantics = normalize_expressions(self.decode_semantics(semantics))
+        sentence_placeholders = set(self.symbols[i] for i in utterance if self.is_placeholder[i])
+        if not check_annotation(sentence, semantics, sentence_placeholders):
+            return None
+        return sentence, semantics
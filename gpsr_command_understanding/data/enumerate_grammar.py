@@ -1,20 +1,21 @@
+import argparse
 import itertools
 import os
 import numpy as np
 from os.path import join
 import re
 
-from gpsr_command_understanding.generator import Generator
-from gpsr_command_understanding.grammar import tree_printer
+from gpsr_command_understanding.generator import get_generator
+from gpsr_command_understanding.grammar import render, render_all
 from gpsr_command_understanding.loading_helpers import load_all_2018_by_cat
 from gpsr_command_understanding.tokens import ROOT_SYMBOL
-from gpsr_command_understanding.generation import generate_sentences, expand_all_semantics, pairs_without_placeholders
+from gpsr_command_understanding.generation import generate_sentences_sharded, pairs_without_placeholders
 from gpsr_command_understanding.util import has_placeholders, determine_unique_cat_data
 
 
 def get_annotated_sentences(sentences_and_pairs):
     sentences, pairs = sentences_and_pairs
-    expanded_sentences = set([tree_printer(x) for x in sentences])
+    expanded_sentences = set(render_all(sentences))
     annotated_sentences = set(pairs.keys())
     # Only keep annotations that cover sentences actually in the grammar
     useless_annotations = annotated_sentences.difference(expanded_sentences)
@@ -23,16 +24,19 @@ def get_annotated_sentences(sentences_and_pairs):
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--processes", default=None, type=int,
+                        help="enumerate each category across this many processes")
+    args = parser.parse_args()
+
     out_root = os.path.abspath(os.path.dirname(__file__) + "/../../data")
     grammar_dir = os.path.abspath(os.path.dirname(__file__) + "/../../resources/generator2018")
 
-    cmd_gen = Generator(grammar_format_version=2018)
+    cmd_gen = get_generator(grammar_format_version=2018)
     generator = load_all_2018_by_cat(cmd_gen, grammar_dir)
 
-    cat_sentences = [set(generate_sentences(ROOT_SYMBOL, rules)) for _,rules, _, _ in generator]
-    pairs = [{utterance: parse for utterance, parse in expand_all_semantics(rules, semantics)} for _, rules, _, semantics in generator]
-
-    pairs = [pairs_without_placeholders(rules, semantics) for _, rules, _, semantics in generator]
+    cat_sentences = [set(generate_sentences_sharded(ROOT_SYMBOL, rules, args.processes)) for _,rules, _, _ in generator]
+    pairs = [pairs_without_placeholders(rules, semantics, processes=args.processes) for _, rules, _, semantics in generator]
     by_utterance, by_parse = determine_unique_cat_data(pairs, keep_new_utterance_repeat_parse_for_lower_cat=False)
     unique = []
     for i, _ in enumerate(cat_sentences):
@@ -47,7 +51,7 @@ def main():
     # Sets should be disjoint
     assert (len(set().union(*unique)) == sum([len(cat) for cat in unique]))
 
-    all_sentences = [tree_printer(x) for x in set().union(*cat_sentences)]
+    all_sentences = render_all(set().union(*cat_sentences))
     all_pairs = pairs
 
     annotated = [get_annotated_sentences(x) for x in zip(cat_sentences, pairs)]
@@ -67,7 +71,7 @@ def main():
         with open(cat_out_path, "w") as f:
             for sentence in sentences:
                 assert not has_placeholders(sentence)
-                f.write(tree_printer(sentence) + '\n')
+                f.write(render(sentence) + '\n')
 
     out_paths = [join(out_root, str(i)+"_pairs.txt") for i in range(1, 4)]
 
@@ -85,7 +89,7 @@ def main():
         for i, (annotated_sen, sen, unique_parses) in enumerate(zip(annotated, cat_sentences, unique_sentence_parses)):
             f.write("cat{0} {1}/{2} {3:.1f}%\n".format(i+1, len(annotated_sen), len(sen), 100.0 * len(annotated_sen) / len(sen)))
             f.write("\t unique parses: {}\n".format(len(unique_parses)))
-            cat_sen_lengths.append([len(tree_printer(sentence).split()) for sentence in sen])
+            cat_sen_lengths.append([len(render(sentence).split()) for sentence in sen])
             avg_sentence_length = np.mean(cat_sen_lengths[i])
             parse_lengths = []
             filtered_parse_lengths = []
@@ -112,7 +116,7 @@ def main():
                 np.mean(all_sen_lengths), np.mean(all_parse_lengths), np.mean(all_filtered_parse_lengths)))
     print("No parses for:")
     for cat in parseless:
-        for sentence in sorted(map(tree_printer, cat)):
+        for sentence in sorted(render_all(cat)):
             print(sentence)
         print("-----------------")
 
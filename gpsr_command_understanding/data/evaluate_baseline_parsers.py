@@ -4,7 +4,7 @@ import os
 import sys
 import editdistance
 
-from gpsr_command_understanding.generator import Generator
+from gpsr_command_understanding.generator import get_generator
 
 from gpsr_command_understanding.loading_helpers import load_all_2018
 from gpsr_command_understanding.models.noop_tokenizer import NoOpTokenizer
@@ -55,7 +55,7 @@ def main():
     val = reader.read(sys.argv[2])
     test = reader.read(sys.argv[3])
 
-    generator = Generator()
+    generator = get_generator()
     rules, rules_anon, rules_ground, semantics, entities = load_all_2018(generator, GRAMMAR_DIR)
     anonymizer = Anonymizer(*entities)
 
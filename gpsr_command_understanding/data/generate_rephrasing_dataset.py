@@ -2,8 +2,8 @@ import os
 import random
 import csv
 
-from gpsr_command_understanding.generator import Generator, get_grounding_per_each_parse
-from gpsr_command_understanding.grammar import tree_printer
+from gpsr_command_understanding.generator import get_generator, get_grounding_per_each_parse
+from gpsr_command_understanding.grammar import render_all
 from gpsr_command_understanding.loading_helpers import load_all_2018_by_cat
 from gpsr_command_understanding.util import chunker
 
@@ -17,12 +17,13 @@ def main():
     grammar_dir = os.path.abspath(os.path.dirname(__file__) + "/../../resources/generator2018")
     out_file_path = os.path.abspath(
         os.path.dirname(__file__) + "/../../data/rephrasings_data_{}_{}.csv".format(seed, groundings_per_parse))
-    cmd_gen = Generator(grammar_format_version=2018)
+    cmd_gen = get_generator(grammar_format_version=2018)
     generator = load_all_2018_by_cat(cmd_gen, grammar_dir)
 
     all_examples = []
+    wild_cache = {}
     for i in range(groundings_per_parse):
-        grounded_examples = get_grounding_per_each_parse(generator, random_source)
+        grounded_examples = get_grounding_per_each_parse(generator, random_source, wild_cache)
         random_source.shuffle(grounded_examples)
         all_examples += grounded_examples
 
@@ -42,7 +43,7 @@ def main():
                 chunk += random_source.sample([pair for chunk in chunks[:i] for pair in chunk], k=needed)
             line = []
             for utterance, parse_anon, parse_ground in chunk:
-                line += [tree_printer(utterance), tree_printer(parse_anon), tree_printer(parse_ground)]
+                line += render_all([utterance, parse_anon, parse_ground])
             output.writerow(line)
 
     # Let's verify that we can load the output back in...
@@ -10,19 +10,27 @@ import random
 import argparse
 import shutil
 from collections import Counter
+from contextlib import contextmanager
 
 import lark
 import more_itertools
 
-from gpsr_command_understanding.generation import pairs_without_placeholders
-from gpsr_command_understanding.generator import Generator, get_grounding_per_each_parse_by_cat
-from gpsr_command_understanding.grammar import tree_printer
+from gpsr_command_understanding.generation import pairs_without_placeholders, profile_generation
+from gpsr_command_understanding.generator import get_generator, get_grounding_per_each_parse_by_cat
+from gpsr_command_understanding.grammar import render
 from gpsr_command_understanding.loading_helpers import load_all_2018_by_cat, load_entities_from_xml
 from gpsr_command_understanding.util import determine_unique_cat_data, save_data, flatten, merge_dicts, \
     get_pairs_by_cats
 
 EPS = 0.00001
 
+
+@contextmanager
+def no_profile():
+    # contextlib.nullcontext needs Python 3.7
+    yield None
+
+
 def validate_args(args):
     if args.test_categories != args.train_categories:
         if len(set(args.test_categories).intersection(set(args.train_categories))) > 0:
@@ -82,7 +90,7 @@ def load_data(path, lambda_parser):
             source_sequence, target_sequence = line, next_line
 
             try:
-                pairs[source_sequence] = tree_printer(lambda_parser.parse(target_sequence))
+                pairs[source_sequence] = render(lambda_parser.parse(target_sequence))
             except lark.exceptions.LarkError:
                 print("Skipping malformed parse: {}".format(target_sequence))
     return pairs
@@ -104,11 +112,13 @@ def main():
     parser.add_argument("--seed", default=0, required=False, type=int)
     parser.add_argument("-i","--incremental-datasets", action='store_true', required=False)
     parser.add_argument("-f", "--force-overwrite", action="store_true", required=False, default=False)
+    parser.add_argument("--profile", default=None, type=str,
+                        help="write a per-nonterminal generation profile to this JSON file")
     args = parser.parse_args()
 
     validate_args(args)
 
-    cmd_gen = Generator(grammar_format_version=2018)
+    cmd_gen = get_generator(grammar_format_version=2018)
     random_source = random.Random(args.seed)
 
     different_test_dist = (args.test_categories != args.train_categories)
@@ -128,16 +138,22 @@ def main():
     generator = load_all_2018_by_cat(cmd_gen, grammar_dir)
 
     pairs = [{}, {}, {}]
-    if args.anonymized:
-        pairs = [pairs_without_placeholders(rules, semantics) for _, rules, _, semantics in generator]
-
-    # For now this only works with all data
-    if args.groundings and len(args.train_categories) == 3:
-        for i in range(args.groundings):
-            groundings = get_grounding_per_each_parse_by_cat(generator,random_source)
-            for cat_pairs, groundings in zip(pairs, groundings):
-                for utt, form_anon, _ in groundings:
-                    pairs[0][tree_printer(utt)] = tree_printer(form_anon)
+    with profile_generation() if args.profile else no_profile() as profile:
+        if args.anonymized:
+            pairs = [pairs_without_placeholders(rules, semantics) for _, rules, _, semantics in generator]
+
+        # For now this only works with all data
+        if args.groundings and len(args.train_categories) == 3:
+            wild_cache = {}
+            for i in range(args.groundings):
+                groundings = get_grounding_per_each_parse_by_cat(generator, random_source, wild_cache)
+                for cat_pairs, groundings in zip(pairs, groundings):
+                    for utt, form_anon, _ in groundings:
+                        pairs[0][render(utt)] = render(form_anon)
+    if profile:
+        print(profile.report(limit=20))
+        with open(args.profile, "w") as f:
+            f.write(profile.to_json())
 
     if args.paraphrasings and len(args.train_categories) == 3:
         paraphrasing_pairs = load_data(args.paraphrasings, cmd_gen.lambda_parser)
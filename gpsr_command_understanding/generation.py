@@ -1,55 +1,388 @@
-import copy
+import hashlib
+import itertools
+import json
+import sys
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 
 from lark import Tree, Token
 
-from gpsr_command_understanding.grammar import CombineExpressions, tree_printer, DiscardVoid
-from gpsr_command_understanding.util import get_placeholders, replace_child_in_tree, replace_words_in_tree, \
-    has_placeholders
+from gpsr_command_understanding.compiled_grammar import CompiledGrammar
+from gpsr_command_understanding.grammar import tree_printer, render, normalize_expressions, expand_shorthand, is_void, \
+    check_annotation, find_choice, count_reachable_derivations
+from gpsr_command_understanding.util import replace_words_in_tree, has_placeholders, \
+    replace_child_in_tree_copy, copy_tree
+from gpsr_command_understanding.semantics import lookup_semantics
 from gpsr_command_understanding.tokens import NonTerminal, WildCard, Anonymized, ROOT_SYMBOL
-try:
-    from queue import Queue as queue
-except ImportError:
-    from Queue import queue
-from yieldfrom import yieldfrom, From, Return
 
 
-def generate_sentences(start_tree, production_rules):
+# Nonterminals with at most this many derivations have them all kept in memory by ExpansionCache
+EXPANSION_CACHE_LIMIT = 100000
+# Most derivations an ExpansionCache holds across all of its nonterminals before it drops the least recently used
+EXPANSION_CACHE_TOTAL_LIMIT = 500000
+
+
+class ExpansionCache(object):
+    """
+    Remembers the fully expanded leaf sequences of nonterminals so that enumeration can stitch cached pieces together
+    instead of re-deriving (and copying) every sentence from scratch. Entries are keyed by the content of the rules a
+    nonterminal can reach rather than by any one rule dict, so rule sets that share rules (every category loads
+    common_rules.txt) share entries, and changing a rule can never serve stale expansions.
+    """
+    def __init__(self, limit=EXPANSION_CACHE_LIMIT, total_limit=EXPANSION_CACHE_TOTAL_LIMIT):
+        """
+        :param limit: nonterminals with more derivations than this are re-derived on demand instead of stored
+        :param total_limit: most derivations to keep across all nonterminals. Least recently used ones go first
+        """
+        self.limit = limit
+        self.total_limit = total_limit
+        self.expansions = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        expansions = self.expansions.get(key)
+        if expansions is not None:
+            self.expansions.move_to_end(key)
+        return expansions
+
+    def put(self, key, expansions):
+        if key in self.expansions:
+            return
+        self.expansions[key] = expansions
+        self.size += len(expansions)
+        while self.size > self.total_limit:
+            _, evicted = self.expansions.popitem(last=False)
+            self.size -= len(evicted)
+
+    def expand(self, start_tree, production_rules):
+        """
+        :return: generator of tuples of leaves, one for every derivation generate_sentences makes
+        """
+        rule_set = _RuleSetExpansion(self, production_rules)
+        for alternative in rule_set.alternatives(start_tree):
+            for leaves in rule_set.product(rule_set.leaves(alternative)):
+                yield leaves
+
+    def clear(self):
+        self.expansions.clear()
+        self.size = 0
+
+
+class _RuleSetExpansion(object):
+    # Bookkeeping for one pass of ExpansionCache.expand over a particular dict of rules
+
+    def __init__(self, cache, production_rules):
+        self.cache = cache
+        self.rules = production_rules
+        self.fingerprints = {}
+        self.counts = {}
+        self._alternatives = {}
+
+    def alternatives(self, tree):
+        # Lazy choices are made up front. Everything else is already a single alternative
+        key = id(tree)
+        if key not in self._alternatives:
+            if find_choice(tree) is None:
+                self._alternatives[key] = (tree, [tree])
+            else:
+                self._alternatives[key] = (tree, expand_shorthand(copy_tree(tree)))
+        return self._alternatives[key][1]
+
+    def leaves(self, tree):
+        return [leaf for leaf in tree.scan_values(lambda x: True) if not is_void(leaf)]
+
+    def count(self, symbol):
+        return count_reachable_derivations(symbol, self._children, self._count_symbol, self.counts,
+                                           lambda symbol: symbol.to_human_readable())
+
+    def _children(self, symbol):
+        return set(leaf for production in self.rules[symbol] for alternative in self.alternatives(production)
+                   for leaf in self.leaves(alternative) if leaf in self.rules)
+
+    def _count_symbol(self, symbol):
+        # Everything the symbol's productions use has been counted already
+        total = 0
+        for production in self.rules[symbol]:
+            for alternative in self.alternatives(production):
+                product = 1
+                for leaf in self.leaves(alternative):
+                    if leaf in self.rules:
+                        product *= self.counts[leaf]
+                total += product
+        return total
+
+    def fingerprint(self, symbol):
+        if symbol in self.fingerprints:
+            return self.fingerprints[symbol]
+        parts = [type(symbol).__name__, str(symbol)]
+        for production in self.rules[symbol]:
+            parts.append(_describe(production))
+            parts.extend(self.fingerprint(leaf) for leaf in production.scan_values(lambda x: x in self.rules))
+        fingerprint = hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+        self.fingerprints[symbol] = fingerprint
+        return fingerprint
+
+    def expansions_of(self, symbol):
+        # Counting first also catches recursive rules before fingerprinting them
+        count = self.count(symbol)
+        key = self.fingerprint(symbol)
+        expansions = self.cache.get(key)
+        if expansions is not None:
+            return expansions
+        if count > self.cache.limit:
+            return self.derive(symbol)
+        expansions = tuple(self.derive(symbol))
+        self.cache.put(key, expansions)
+        return expansions
+
+    def derive(self, symbol):
+        # generate_sentences pops the last production off of its stack first
+        for production in reversed(self.rules[symbol]):
+            for alternative in self.alternatives(production):
+                for leaves in self.product(self.leaves(alternative)):
+                    yield leaves
+
+    def product(self, leaves, start=0):
+        # Every combination of expansions of the leaves, leftmost varying slowest
+        if start == len(leaves):
+            yield ()
+            return
+        head = leaves[start]
+        if head in self.rules:
+            for expansion in self.expansions_of(head):
+                for rest in self.product(leaves, start + 1):
+                    yield expansion + rest
+        else:
+            for rest in self.product(leaves, start + 1):
+                yield (head,) + rest
+
+
+def _describe(tree):
+    # Spells out the structure and the type of every leaf, so different rules can't share a fingerprint
+    if isinstance(tree, Tree):
+        return "({} {})".format(tree.data, " ".join(_describe(child) for child in tree.children))
+    return "{}:{}".format(type(tree).__name__, tree)
+
+
+# Shared by every generate_sentences call that doesn't bring its own. Bounded, so long-running processes that see
+# many rule sets don't accumulate expansions forever
+_default_expansion_cache = ExpansionCache()
+
+
+def generate_sentences(start_tree, production_rules, expansion_cache=None):
     """
     A generator that produces completely expanded sentences in depth-first order
     :param start_tree: the list of tokens to begin expanding
     :param production_rules: the rules to use for expanding the tokens
+    :param expansion_cache: where to keep expansions of nonterminals between calls. Defaults to one shared by the process
     """
     # Make sure the start point is a Tree
     if isinstance(start_tree, NonTerminal):
-        stack = [Tree("expression", [start_tree])]
+        start_tree = Tree("expression", [start_tree])
     elif isinstance(start_tree, list):
-        stack = [Tree("expression", start_tree)]
-    else:
-        stack = [start_tree]
-
-    while len(stack) != 0:
-        sentence = stack.pop()
-        replace_tokens = list(sentence.scan_values(lambda x: x in production_rules.keys()))
-        if replace_tokens:
-            replace_token = replace_tokens[0]
-            # Replace it every way we know how
-            for production in production_rules[replace_token]:
-                modified_sentence = copy.deepcopy(sentence)
-                replace_child_in_tree(modified_sentence, replace_token, production, only_once=True)
-                # Generate the rest of the sentence recursively assuming this replacement
-                stack.append(modified_sentence)
-        else:
-            # If we couldn't replace anything else, this sentence is done!
-            sentence = CombineExpressions().visit(sentence)
-            sentence = DiscardVoid().visit(sentence)
-            yield sentence
+        start_tree = Tree("expression", start_tree)
+
+    cache = expansion_cache if expansion_cache is not None else _default_expansion_cache
+    for leaves in cache.expand(start_tree, production_rules):
+        yield Tree("expression", list(leaves))
 
 
 def generate_random_pair(start_symbols, production_rules, semantics_rules, yield_requires_semantics=False, random_generator=None):
     return next(generate_sentence_parse_pairs(start_symbols, production_rules, semantics_rules, yield_requires_semantics=yield_requires_semantics, branch_cap=1, random_generator=random_generator))
 
 
-def generate_sentence_parse_pairs(start_tree, production_rules, semantics_rules, start_semantics=None, yield_requires_semantics=True, branch_cap=None, random_generator=None):
+def generate_uniform_pairs(production_rules, semantics_rules, random_generator=None):
+    """
+    Stream pairs sampled uniformly from everything expand_all_semantics produces. Unlike generate_random_pair,
+    long derivations aren't less likely than short ones.
+    :param random_generator: a random.Random to draw from
+    :return: an endless generator of (utterance, semantics) Trees
+    """
+    return CompiledGrammar(production_rules, semantics_rules).sample_pairs(random_generator)
+
+
+def traverse(start, expand, order="bfs", max_frontier=None, stop=None, observe=None):
+    """
+    Walk every derivation reachable from a start state.
+    "bfs" visits them level by level, but holds a whole level of partial derivations at once. "dfs" only keeps the
+    derivation currently being expanded and its pending siblings' generators, so memory grows with derivation depth.
+    "iddfs" reruns a depth-limited "dfs" for each depth, which gives the same order as "bfs" in the same memory as
+    "dfs" at the cost of re-expanding shallow levels. It needs expand to be deterministic.
+    :param start: the state to begin from
+    :param expand: function mapping a state to an iterable of successor states. States without successors are done
+    :param order: "bfs", "dfs" or "iddfs"
+    :param max_frontier: raise a RuntimeError if more than this many states (or, for the depth-first orders, levels)
+        are held waiting at once
+    :param stop: function called before each expansion. The walk ends quietly as soon as it returns true
+    :param observe: function called with the number of states (or levels) waiting after each expansion
+    :return: generator of finished states
+    """
+    if order == "bfs":
+        frontier = deque([start])
+        while frontier:
+            if stop and stop():
+                return
+            state = frontier.popleft()
+            expansions = list(expand(state))
+            if not expansions:
+                yield state
+                continue
+            frontier.extend(expansions)
+            _check_frontier(len(frontier), max_frontier)
+            if observe:
+                observe(len(frontier))
+    elif order == "dfs":
+        for state, _ in _depth_first(start, expand, None, max_frontier, stop, observe):
+            yield state
+    elif order == "iddfs":
+        depth_limit = 0
+        while True:
+            truncated = False
+            for state, depth in _depth_first(start, expand, depth_limit, max_frontier, stop, observe):
+                if state is None:
+                    truncated = True
+                elif depth == depth_limit:
+                    # Shallower derivations finished in an earlier pass
+                    yield state
+            if not truncated or (stop and stop()):
+                return
+            depth_limit += 1
+    else:
+        raise ValueError("Unknown traversal order {}".format(order))
+
+
+def _depth_first(start, expand, depth_limit, max_frontier, stop=None, observe=None):
+    # Yields (finished state, depth), plus (None, depth) wherever depth_limit cut a derivation short
+    stack = [iter([start])]
+    while stack:
+        if stop and stop():
+            return
+        state = next(stack[-1], None)
+        if state is None:
+            stack.pop()
+            continue
+        depth = len(stack) - 1
+        successors = iter(expand(state))
+        first = next(successors, None)
+        if first is None:
+            yield state, depth
+        elif depth_limit is not None and depth >= depth_limit:
+            yield None, depth
+        else:
+            stack.append(itertools.chain([first], successors))
+            _check_frontier(len(stack), max_frontier)
+            if observe:
+                observe(len(stack))
+
+
+class _Budget(object):
+    """
+    Limits on one call to a pair generator. A pair cap, a time limit in seconds and a cancel callback, any of which
+    may be None
+    """
+    def __init__(self, max_pairs=None, time_limit=None, cancel=None):
+        self.remaining = max_pairs
+        self.deadline = time.monotonic() + time_limit if time_limit is not None else None
+        self.cancel = cancel
+
+    def exhausted(self):
+        return (self.remaining is not None and self.remaining <= 0) or \
+               (self.deadline is not None and time.monotonic() >= self.deadline) or \
+               bool(self.cancel and self.cancel())
+
+    def spend(self):
+        if self.remaining is not None:
+            self.remaining -= 1
+
+
+class GenerationProfile(object):
+    """
+    Where pair generation spent its effort, by the nonterminal being expanded and by the utterance generation started
+    from (for expand_all_semantics, each semantics rule). Times are the generator's own, not its consumer's.
+    Fill one in with profile_generation.
+    """
+    def __init__(self):
+        self.nonterminals = {}
+        self.starts = {}
+
+    def expanding(self, nonterminal):
+        return self._expanding(_describe_symbols([nonterminal]))
+
+    def expanding_choice(self):
+        # Lazy choices aren't nonterminals, but making them costs copies all the same
+        return self._expanding("(choice)")
+
+    def _expanding(self, name):
+        stats = self.nonterminals.get(name)
+        if stats is None:
+            stats = self.nonterminals[name] = {"expansions": 0, "productions": 0, "copies": 0, "seconds": 0.}
+        stats["expansions"] += 1
+        return stats
+
+    def generating(self, start_tree):
+        name = _describe_symbols(start_tree.scan_values(lambda x: True))
+        stats = self.starts.get(name)
+        if stats is None:
+            stats = self.starts[name] = {"pairs": 0, "expansions": 0, "frontier_peak": 0, "seconds": 0.}
+        return stats
+
+    def as_dict(self):
+        return {"nonterminals": self.nonterminals, "starts": self.starts}
+
+    def to_json(self):
+        """
+        :return: the profile as JSON with sorted keys, so profiles of two grammar revisions diff cleanly
+        """
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def report(self, limit=None):
+        """
+        :param limit: how many of the most expensive entries to show in each table
+        :return: text tables of nonterminals and starting utterances, most time first
+        """
+        lines = []
+        for title, table, columns in [("nonterminal", self.nonterminals, ["expansions", "productions", "copies"]),
+                                      ("start", self.starts, ["pairs", "expansions", "frontier_peak"])]:
+            lines.append("{:<60} ".format(title) + " ".join("{:>13}".format(column) for column in columns + ["seconds"]))
+            ranked = sorted(table.items(), key=lambda item: (-item[1]["seconds"], item[0]))
+            for name, stats in ranked[:limit]:
+                lines.append("{:<60} ".format(name) + " ".join("{:>13}".format(stats[column]) for column in columns) +
+                             " {:>13.4f}".format(stats["seconds"]))
+            lines.append("")
+        return "\n".join(lines)
+
+
+def _describe_symbols(symbols):
+    return " ".join(symbol.to_human_readable() if isinstance(symbol, NonTerminal) else str(symbol) for symbol in symbols)
+
+
+# Set while profile_generation is active. Generation only does its bookkeeping when there's a profile to fill
+_active_profile = None
+
+
+@contextmanager
+def profile_generation():
+    """
+    Profile all pair generation started inside the block, even if it's consumed after the block exits. Generation
+    running in other processes isn't counted.
+    :return: the GenerationProfile being filled in
+    """
+    global _active_profile
+    previous = _active_profile
+    _active_profile = GenerationProfile()
+    try:
+        yield _active_profile
+    finally:
+        _active_profile = previous
+
+
+def _check_frontier(size, max_frontier):
+    if max_frontier is not None and size > max_frontier:
+        raise RuntimeError("Generation frontier grew past {} entries. Try order=\"dfs\"".format(max_frontier))
+
+
+def generate_sentence_parse_pairs(start_tree, production_rules, semantics_rules, start_semantics=None, yield_requires_semantics=True, branch_cap=None, random_generator=None, order="bfs", max_frontier=None, max_pairs=None, time_limit=None, cancel=None):
     """
     Expand the start_symbols in breadth first order. At each expansion, see if we have an associated semantic template.
     If the current expansion has a semantics associated, also apply the expansion to the semantics.
@@ -59,7 +392,19 @@ def generate_sentence_parse_pairs(start_tree, production_rules, semantics_rules,
     :param production_rules:
     :param semantics_rules: dict mapping a sequence of tokens to a semantic template
     :param yield_requires_semantics: if true, will yield sentences that don't have associated semantics. Helpful for debugging.
+    :param order: how to walk the expansions. See traverse
+    :param max_frontier: see traverse
+    :param max_pairs: stop after yielding this many pairs
+    :param time_limit: stop after this many seconds, wherever expansion has gotten to
+    :param cancel: function called between expansions. Generation stops as soon as it returns true
     """
+    # Bind the profile now, while any profile_generation block the call is made in is still active
+    return _generate_sentence_parse_pairs(start_tree, production_rules, semantics_rules, start_semantics,
+                                          yield_requires_semantics, branch_cap, random_generator, order, max_frontier,
+                                          max_pairs, time_limit, cancel, _active_profile)
+
+
+def _generate_sentence_parse_pairs(start_tree, production_rules, semantics_rules, start_semantics, yield_requires_semantics, branch_cap, random_generator, order, max_frontier, max_pairs, time_limit, cancel, profile):
     """print(parsed.pretty())
     to_str = ToString()
     result = to_str.transform(parsed)
@@ -72,88 +417,93 @@ def generate_sentence_parse_pairs(start_tree, production_rules, semantics_rules,
         start_tree = Tree("expression", start_tree)
     else:
         assert isinstance(start_tree, Tree)
-
-    frontier = queue()
-    frontier.put((start_tree, start_semantics))
-    while not frontier.empty():
-        sentence, semantics = frontier.get()
-        if not semantics:
-            # Let's see if the  expansion is associated with any semantics
-            semantics = semantics_rules.get(sentence)
-        expansions = list(expand_pair(sentence, semantics, production_rules, branch_cap=branch_cap, random_generator=random_generator))
-        if not expansions:
-            # If we couldn't replace anything else, this sentence is done!
-            if semantics:
-                DiscardVoid().visit(semantics)
-                CombineExpressions().visit(semantics)
-                sem_placeholders_remaining = get_placeholders(semantics)
-                sentence_placeholders_remaining = get_placeholders(sentence)
-                # Are there placeholders in the semantics that aren't left in the sentence? These will never get expanded,
-                # so it's almost certainly an error
-                probably_should_be_filled = sem_placeholders_remaining.difference(sentence_placeholders_remaining)
-                if len(probably_should_be_filled) > 0:
-                    print("Unfilled placeholders {}".format(" ".join(map(str, probably_should_be_filled))))
-                    print(tree_printer.transform(sentence))
-                    print(tree_printer.transform(semantics))
-                    print("This annotation is probably wrong")
-                    print("")
-                    continue
-                elif len(sem_placeholders_remaining) != len(sentence_placeholders_remaining):
-                    not_in_annotation = sentence_placeholders_remaining.difference(sem_placeholders_remaining)
-                    print("Annotation is missing wildcards that are present in the original sentence. Were they left out accidentally?")
-                    print(" ".join(map(str,not_in_annotation)))
-                    print(tree_printer.transform(sentence))
-                    print(tree_printer.transform(semantics))
-                    print("")
-            elif yield_requires_semantics:
-                # This won't be a pair without semantics, so we'll just skip it
+    if order == "iddfs" and random_generator:
+        raise ValueError("Iterative deepening re-expands derivations, so it can't be used with a random generator")
+
+    start_stats = profile.generating(start_tree) if profile else None
+
+    def expand(state):
+        if start_stats:
+            start_stats["expansions"] += 1
+        for sentence, semantics, pending in _expand_pair(state[0], state[1], state[2], production_rules, branch_cap=branch_cap, random_generator=random_generator, profile=profile):
+            if not semantics:
+                # Let's see if the  expansion is associated with any semantics
+                semantics = lookup_semantics(semantics_rules, sentence)
+            yield sentence, semantics, pending
+
+    if not start_semantics:
+        start_semantics = lookup_semantics(semantics_rules, start_tree)
+    budget = _Budget(max_pairs, time_limit, cancel)
+    observe = _frontier_peak(start_stats) if start_stats else None
+    clock = time.perf_counter()
+    # Each partial derivation carries the positions of its placeholders, so expanding it doesn't need a scan
+    for sentence, semantics, _ in traverse((start_tree, start_semantics, None), expand, order=order, max_frontier=max_frontier, stop=budget.exhausted, observe=observe):
+        # If we couldn't replace anything else, this sentence is done!
+        if semantics:
+            semantics = normalize_expressions(semantics)
+            if not check_annotation(sentence, semantics):
                 continue
-            yield (sentence, semantics)
+        elif yield_requires_semantics:
+            # This won't be a pair without semantics, so we'll just skip it
             continue
-        for pair in expansions:
-            frontier.put(pair)
+        budget.spend()
+        if start_stats:
+            start_stats["pairs"] += 1
+            start_stats["seconds"] += time.perf_counter() - clock
+        yield (sentence, semantics)
+        clock = time.perf_counter()
+    if start_stats:
+        start_stats["seconds"] += time.perf_counter() - clock
 
-        # What productions don't have semantics?
-        """if not modified_semantics:
-            print(sentence_filled.pretty())
-        """
 
+def _frontier_peak(stats):
+    def observe(size):
+        if size > stats["frontier_peak"]:
+            stats["frontier_peak"] = size
+    return observe
 
-def generate_sentence_slot_pairs(start_tree, production_rules, semantics_rules, start_semantics=None, yield_requires_semantics=True, branch_cap=None, random_generator=None):
 
+def generate_sentence_slot_pairs(start_tree, production_rules, semantics_rules, start_semantics=None, yield_requires_semantics=True, branch_cap=None, random_generator=None, order="bfs", max_frontier=None, max_pairs=None, time_limit=None, cancel=None):
+    """
+    :param max_pairs: stop after yielding this many pairs
+    :param time_limit: stop after this many seconds, wherever expansion has gotten to
+    :param cancel: function called between expansions. Generation stops as soon as it returns true
+    """
+    # Bind the profile now, while any profile_generation block the call is made in is still active
+    return _generate_sentence_slot_pairs(start_tree, production_rules, semantics_rules, start_semantics,
+                                         yield_requires_semantics, branch_cap, random_generator, order, max_frontier,
+                                         max_pairs, time_limit, cancel, _active_profile)
+
+
+def _generate_sentence_slot_pairs(start_tree, production_rules, semantics_rules, start_semantics, yield_requires_semantics, branch_cap, random_generator, order, max_frontier, max_pairs, time_limit, cancel, profile):
     if isinstance(start_tree, NonTerminal):
         start_tree = Tree("expression", [start_tree])
     elif isinstance(start_tree, list):
         start_tree = Tree("expression", start_tree)
     else:
         assert isinstance(start_tree, Tree)
-
-    frontier = Queue()
-    frontier.put((start_tree, start_semantics))
-    while not frontier.empty():
-        sentence, semantics = frontier.get()
-        #if not semantics:
-        #    semantics = semantics_rules.get(sentence)
-        #if semantics_rules.get(sentence):
-        #    if semantics and semantics.children[0].data == "intent":
-        #        semantics.children[1] = semantics_rules.get(sentence)
-        #    else:
-        #        semantics = semantics_rules.get(sentence)
-            #print(semantics)
-
-        expansions = list(expand_pair_slot(sentence, semantics, production_rules, semantics_rules, branch_cap=branch_cap, random_generator=random_generator))
-        if not expansions:
-            #print("Sentence: ", sentence.pretty())
-            #print("Semantics: ", semantics.pretty())
-            yield (sentence, semantics)
-            #print(sentence)
-            #print(semantics)
-            #print(semantics.children[0].data)
-            #print("---------------------")
-            continue
-
-        for pair in expansions:
-            frontier.put(pair)
+    if order == "iddfs" and random_generator:
+        raise ValueError("Iterative deepening re-expands derivations, so it can't be used with a random generator")
+
+    start_stats = profile.generating(start_tree) if profile else None
+
+    def expand(state):
+        if start_stats:
+            start_stats["expansions"] += 1
+        return _expand_pair_slot(state[0], state[1], state[2], production_rules, semantics_rules, branch_cap=branch_cap, random_generator=random_generator, profile=profile)
+
+    budget = _Budget(max_pairs, time_limit, cancel)
+    observe = _frontier_peak(start_stats) if start_stats else None
+    clock = time.perf_counter()
+    for sentence, semantics, _ in traverse((start_tree, start_semantics, None), expand, order=order, max_frontier=max_frontier, stop=budget.exhausted, observe=observe):
+        budget.spend()
+        if start_stats:
+            start_stats["pairs"] += 1
+            start_stats["seconds"] += time.perf_counter() - clock
+        yield sentence, semantics
+        clock = time.perf_counter()
+    if start_stats:
+        start_stats["seconds"] += time.perf_counter() - clock
 
 
 def expand_pair_full(sentence, semantics, production_rules, branch_cap=None, random_generator=None):
@@ -161,90 +511,225 @@ def expand_pair_full(sentence, semantics, production_rules, branch_cap=None, ran
                                        branch_cap=branch_cap, random_generator=random_generator)
 
 
+def expand_choice(sentence, semantics, choice, branch_cap=None, random_generator=None, stats=None):
+    """
+    Make a lazy choice every way (or branch_cap random ways). If the same choice was carried into the
+    semantics, it's made the same way there.
+    :param stats: profile entry to count the options and copies in
+    """
+    clock = time.perf_counter() if stats else None
+    options = choice.children
+    if random_generator:
+        if branch_cap:
+            options = random_generator.sample(options, k=min(branch_cap, len(options)))
+        else:
+            options = list(options)
+            random_generator.shuffle(options)
+
+    for option in options:
+        if isinstance(option, Tree):
+            # Each expansion gets its own nodes, as it would if the whole tree were deep copied
+            option = copy_tree(normalize_expressions(option))
+            if stats:
+                stats["copies"] += 1
+        modified_sentence = replace_child_in_tree_copy(sentence, choice, option, only_once=True)
+        sentence_filled = normalize_expressions(modified_sentence)
+
+        modified_semantics = None
+        if semantics:
+            modified_semantics = replace_child_in_tree_copy(semantics, choice, option, only_once=True)
+        if stats:
+            stats["productions"] += 1
+            stats["seconds"] += time.perf_counter() - clock
+        yield sentence_filled, modified_semantics
+        if stats:
+            clock = time.perf_counter()
+
+
 def expand_pair(sentence, semantics, production_rules, branch_cap=None, random_generator=None):
-        replace_token = list(sentence.scan_values(lambda x: x in production_rules.keys()))
+    expansions = _expand_pair(sentence, semantics, None, production_rules, branch_cap=branch_cap, random_generator=random_generator, profile=_active_profile)
+    return ((sentence_filled, semantics_filled) for sentence_filled, semantics_filled, _ in expansions)
 
-        if not replace_token:
+
+def _expand_pair(sentence, semantics, pending, production_rules, branch_cap=None, random_generator=None, profile=None):
+        """
+        :param pending: positions of the sentence's placeholders, as yielded with its parent's expansion. None to
+            find them by scanning the sentence
+        :param profile: GenerationProfile to record the expansion in, if any
+        :return: generator of (sentence, semantics, pending)
+        """
+        if pending is None:
+            # Choices come first so that utterances are choice-free by the time we try to match them to semantics
+            choice = find_choice(sentence)
+            if choice:
+                stats = profile.expanding_choice() if profile else None
+                for sentence_filled, semantics_filled in expand_choice(sentence, semantics, choice, branch_cap=branch_cap, random_generator=random_generator, stats=stats):
+                    yield sentence_filled, semantics_filled, None
+                return
+
+        replace_token, position, pending = _pick_placeholder(sentence, pending, production_rules, random_generator)
+        if replace_token is None:
             return
+        stats = profile.expanding(replace_token) if profile else None
+        clock = time.perf_counter() if stats else None
 
         if random_generator:
-            replace_token = random_generator.choice(replace_token)
             replacement_rules = production_rules[replace_token]
             if branch_cap:
                 productions = random_generator.sample(replacement_rules, k=branch_cap)
             else:
-                # Use all of the branches
-                productions = production_rules[replace_token]
+                # Use all of the branches. Shuffle a copy; expansions suspended further up a depth-first search may
+                # still be iterating over the rule's own list
+                productions = list(production_rules[replace_token])
                 random_generator.shuffle(productions)
         else:
-            # We know we have at least one, so we'll just use the first
-            replace_token = replace_token[0]
             productions = production_rules[replace_token]
 
         for production in productions:
-            modified_sentence = copy.deepcopy(sentence)
-            replace_child_in_tree(modified_sentence, replace_token, production, only_once=True)
-            modified_sentence = DiscardVoid().visit(modified_sentence)
-
-            # Normalize any chopped up text fragments to make sure we can pull semantics for these cases
-            sentence_filled = CombineExpressions().visit(modified_sentence)
+            # Expansions never modify the sentence or semantics they start from, so they only copy what they change
+            production = normalize_expressions(production)
+            filled = _fill_placeholder(sentence, pending, position, production, production_rules)
+            if filled:
+                sentence_filled, pending_filled = filled
+            else:
+                if any(isinstance(child, Tree) for child in production.children):
+                    # Give each expansion its own choice nodes, as it would have if the whole tree were deep copied
+                    production = copy_tree(production)
+                    if stats:
+                        stats["copies"] += 1
+                modified_sentence = replace_child_in_tree_copy(sentence, replace_token, production, only_once=True)
+
+                # Normalize any chopped up text fragments to make sure we can pull semantics for these cases
+                sentence_filled = normalize_expressions(modified_sentence)
+                pending_filled = None
             # If we've got semantics for this expansion already, see if the replacements apply to them
             # For the basic annotation we provided, this should only happen when expanding ground terms
             
             modified_semantics = None
             if semantics:
-                modified_semantics = copy.deepcopy(semantics)
                 sem_substitute = production
                 if isinstance(replace_token, WildCard) or (len(production.children) >0 and isinstance(production.children[0], Anonymized)):
-                    sem_substitute = production.copy()
-                    sem_substitute.children = ["\""] + sem_substitute.children + ["\""]
-                replace_child_in_tree(modified_semantics, replace_token, sem_substitute)
-            yield sentence_filled, modified_semantics
+                    sem_substitute = Tree(production.data, ["\""] + production.children + ["\""])
+                modified_semantics = replace_child_in_tree_copy(semantics, replace_token, sem_substitute)
+            if stats:
+                stats["productions"] += 1
+                stats["seconds"] += time.perf_counter() - clock
+            yield sentence_filled, modified_semantics, pending_filled
+            if stats:
+                clock = time.perf_counter()
+
+
+def _pick_placeholder(sentence, pending, production_rules, random_generator=None):
+    """
+    Picks the placeholder to expand next: the first one, or a random one if there's a random generator.
+    :param pending: positions of the sentence's placeholders, or None if they aren't known yet
+    :return: (placeholder, its position, positions of all placeholders). The positions are None for sentences that
+        aren't flat and normalized. The placeholder is None if there aren't any left
+    """
+    if pending is None:
+        pending = _placeholder_positions(sentence, production_rules)
+    if pending is None:
+        replace_token = list(sentence.scan_values(lambda x: x in production_rules.keys()))
+        if not replace_token:
+            return None, None, None
+        if random_generator:
+            return random_generator.choice(replace_token), None, None
+        # We know we have at least one, so we'll just use the first
+        return replace_token[0], None, None
+    if not pending:
+        return None, None, pending
+    if random_generator:
+        replace_token = sentence.children[random_generator.choice(pending)]
+        # Expansion replaces the first occurrence, same as replace_child_in_tree
+        return replace_token, next(i for i in pending if sentence.children[i] == replace_token), pending
+    return sentence.children[pending[0]], pending[0], pending
+
+
+def _placeholder_positions(sentence, production_rules):
+    # Only flat, normalized sentences can be filled in place. Anything else goes through a full replace and normalize
+    if sentence.data != "expression":
+        return None
+    positions = []
+    for i, child in enumerate(sentence.children):
+        if isinstance(child, Tree) or is_void(child):
+            return None
+        if child in production_rules:
+            positions.append(i)
+    return tuple(positions)
+
+
+def _fill_placeholder(sentence, pending, position, production, production_rules):
+    """
+    Splices a flat, normalized production into a flat sentence in place of the placeholder at the position. This is
+    what replacing the placeholder and normalizing the sentence would give, without looking at the rest of the sentence.
+    :return: (filled sentence, positions of its placeholders), or None if this shortcut doesn't apply
+    """
+    if position is None or production.data != "expression" or any(
+            isinstance(child, Tree) for child in production.children):
+        return None
+    children = sentence.children
+    words = production.children
+    k = pending.index(position)
+    shift = len(words) - 1
+    pending_filled = pending[:k] + tuple(position + i for i, word in enumerate(words) if word in production_rules) + \
+        tuple(i + shift for i in pending[k + 1:])
+    return Tree("expression", children[:position] + words + children[position + 1:]), pending_filled
 
 
 def expand_pair_slot(sentence, semantics, production_rules, semantics_rules, branch_cap=None, random_generator=None):
+    for sentence_filled, semantics_filled, _ in _expand_pair_slot(sentence, semantics, None, production_rules, semantics_rules, branch_cap=branch_cap, random_generator=random_generator):
+        yield sentence_filled, semantics_filled
+
+
+def _expand_pair_slot(sentence, semantics, pending, production_rules, semantics_rules, branch_cap=None, random_generator=None, profile=None):
         #print("sentence: " + sentence.pretty())
         #if semantics:
         #    print("semantics: " + semantics.pretty())
         #else:
         #    print("semantics: None")
 
-        replace_token = list(sentence.scan_values(lambda x: x in production_rules.keys()))
+        replace_token, position, pending = _pick_placeholder(sentence, pending, production_rules, random_generator)
 
-        if not replace_token:
+        if replace_token is None:
             return
+        stats = profile.expanding(replace_token) if profile else None
+        clock = time.perf_counter() if stats else None
 
         if random_generator:
-            replace_token = random_generator.choice(replace_token)
             replacement_rules = production_rules[replace_token]
             if branch_cap:
                 productions = random_generator.sample(replacement_rules, k=min(branch_cap, len(replacement_rules)))
             else:
-                # Use all of the branches
-                productions = production_rules[replace_token]
+                # Use all of the branches. Shuffle a copy; expansions suspended further up a depth-first search may
+                # still be iterating over the rule's own list
+                productions = list(production_rules[replace_token])
                 random_generator.shuffle(productions)
         else:
-            # We know we have at least one, so we'll just use the first
-            replace_token = replace_token[0]
             productions = production_rules[replace_token]
 
         #print("replace: ", replace_token)
 
         for production in productions:
-            modified_sentence = copy.deepcopy(sentence)
-            replace_child_in_tree(modified_sentence, replace_token, copy.deepcopy(production), only_once=True)
-            modified_sentence = DiscardVoid().visit(modified_sentence)
+            filled = _fill_placeholder(sentence, pending, position, normalize_expressions(production), production_rules)
+            if filled:
+                sentence_filled, pending_filled = filled
+            else:
+                modified_sentence = replace_child_in_tree_copy(sentence, replace_token, copy_tree(production), only_once=True)
+                if stats:
+                    stats["copies"] += 1
 
-            # Normalize any chopped up text fragments to make sure we can pull semantics for these cases
-            sentence_filled = CombineExpressions().visit(modified_sentence)
+                # Normalize any chopped up text fragments to make sure we can pull semantics for these cases
+                sentence_filled = normalize_expressions(modified_sentence)
+                pending_filled = None
             # If we've got semantics for this expansion already, see if the replacements apply to them
             # For the basic annotation we provided, this should only happen when expanding ground terms
             
             modified_semantics = None
             if semantics:
-                modified_semantics = copy.deepcopy(semantics)
+                modified_semantics = semantics
 
-                sem_substitute = get_semantic_substitute(replace_token, copy.deepcopy(production), semantics_rules)
+                # The substitute is always a fresh tree, so it's safe to modify
+                sem_substitute = get_semantic_substitute(replace_token, production, semantics_rules)
 
                 if len(sem_substitute.children) > 0 and isinstance(sem_substitute.children[0], Tree) and sem_substitute.children[0].data == "intent":
                     #copy slot data
@@ -254,38 +739,46 @@ def expand_pair_slot(sentence, semantics, production_rules, semantics_rules, bra
                     #now intent is the first child, with previous slot info
                     modified_semantics = sem_substitute
                     #replace the token in previous slot info with
-                    replace_child_in_tree(modified_semantics, replace_token, slot, only_once=True)
+                    modified_semantics = replace_child_in_tree_copy(modified_semantics, replace_token, slot, only_once=True)
                 else:
-                    replace_child_in_tree(modified_semantics, replace_token, sem_substitute, only_once=True)
+                    modified_semantics = replace_child_in_tree_copy(modified_semantics, replace_token, sem_substitute, only_once=True)
 
 
                 #print("replace_token", replace_token)
                 #print("sem_substitute", sem_substitute.pretty())
             else:
-                modified_semantics = get_semantic_substitute(replace_token, copy.deepcopy(production), semantics_rules)
+                modified_semantics = get_semantic_substitute(replace_token, production, semantics_rules)
+            if stats:
+                # get_semantic_substitute always builds a new tree
+                stats["copies"] += 1
 
-            DiscardVoid().visit(modified_semantics)
-            if isinstance(modified_semantics, Tree):
-                CombineExpressions().visit(modified_semantics)
+            modified_semantics = normalize_expressions(modified_semantics)
             #print(tree_printer(sentence_filled))
             #print(modified_semantics)
-            yield sentence_filled, modified_semantics
+            if stats:
+                stats["productions"] += 1
+                stats["seconds"] += time.perf_counter() - clock
+            yield sentence_filled, modified_semantics, pending_filled
+            if stats:
+                clock = time.perf_counter()
             #print("-----------------------")
 
 
 def get_semantic_substitute(replace_token, production, semantics_rules):
-    
+    """
+    :return: a new tree that the caller is free to modify. Neither the production nor the rules are changed
+    """
     sem_substitute = None
     sem_replace = semantics_rules.get(replace_token)
     if sem_replace:
-        return copy.deepcopy(sem_replace)
+        return copy_tree(sem_replace)
 
     sem_production = semantics_rules.get(production)
     if sem_production:
         if (len(production.children) == 1) and isinstance(production.children[0], WildCard):
             pass
         else:
-            return copy.deepcopy(sem_production)
+            return copy_tree(sem_production)
 
     if isinstance(replace_token, WildCard):
         #print("expanding wildcard: ", replace_token)
@@ -294,7 +787,7 @@ def get_semantic_substitute(replace_token, production, semantics_rules):
 
         return iob2_tagging(sem, production)
 
-    sem_substitute = copy.deepcopy(production)
+    sem_substitute = copy_tree(production)
     replace_words_in_tree(sem_substitute, Token('WORD', 'O'))
     return sem_substitute
 
@@ -305,7 +798,7 @@ def iob2_tagging(sem, production):
     words = production.children[0].split(" ")
 
     if sem:
-        sem = copy.deepcopy(sem.children[0])
+        sem = sem.children[0]
         for i, word in enumerate(words):
             tag = Token('WORD', "B-" + sem) if i == 0 else Token('WORD', "I-" + sem)
             sem_substitute.children.append(tag)
@@ -317,7 +810,6 @@ def iob2_tagging(sem, production):
     return sem_substitute
     
 
-@yieldfrom
 def expand_all_semantics(production_rules, semantics_rules):
     """
     Expands all semantics rules
@@ -325,21 +817,103 @@ def expand_all_semantics(production_rules, semantics_rules):
     :param semantics_rules:
     """
     for utterance, parse in semantics_rules.items():
-        yield From(generate_sentence_parse_pairs(utterance, production_rules, semantics_rules, False))
+        # yieldfrom's From() raises StopIteration inside a generator, which is an error since Python 3.7
+        for pair in generate_sentence_parse_pairs(utterance, production_rules, semantics_rules, False):
+            yield pair
 
 
-def pairs_without_placeholders(rules, semantics, only_in_grammar=False):
-    pairs = expand_all_semantics(rules, semantics)
+def pairs_without_placeholders(rules, semantics, only_in_grammar=False, processes=None):
+    """
+    :param processes: if more than 1, expand the semantics rules across a pool of this many processes. The result is
+        the same either way
+    :return: dict mapping each printed utterance to its printed parse
+    """
     out = {}
-    all_utterances_in_grammar = set(generate_sentences(ROOT_SYMBOL, rules))
-    for command, parse in pairs:
+    # Checks commands one at a time instead of enumerating the grammar's whole language
+    grammar = CompiledGrammar(rules) if only_in_grammar else None
+    for command, command_str, parse_str in _map_shards(_expand_semantics_shard, list(semantics.keys()), rules,
+                                                       semantics, processes, only_in_grammar):
+        # If it's important that we only get pairs that are in the grammar, check to make sure
+        if only_in_grammar and not grammar.recognizes(command, ROOT_SYMBOL):
+            continue
+        out[command_str] = parse_str
+    return out
+
+
+def generate_sentences_sharded(start_symbol, production_rules, processes=None):
+    """
+    Enumerate every distinct sentence, splitting the work by the start symbol's productions across a pool of
+    processes.
+    :param processes: how many processes to use. Sequential if None or 1
+    :return: list of distinct sentences, in the order generate_sentences first produces them
+    """
+    if start_symbol not in production_rules:
+        return list(_unique(generate_sentences(start_symbol, production_rules)))
+    # generate_sentences takes the last production first
+    shards = list(reversed(range(len(production_rules[start_symbol]))))
+    leaves = _map_shards(_expand_production_shard, shards, production_rules, None, processes, start_symbol)
+    return [Tree("expression", list(sentence)) for sentence in _unique(leaves)]
+
+
+def _unique(items):
+    return dict.fromkeys(items).keys()
+
+
+def _map_shards(shard_func, shards, production_rules, semantics_rules, processes, *args):
+    """
+    Runs shard_func(production_rules, semantics_rules, shard, *args) on each shard, in a process pool if processes is
+    more than 1. Workers get the rules once, when they start.
+    :param shards: list of shard arguments
+    :return: generator of everything the shards return, in shard order
+    """
+    if not processes or processes <= 1:
+        for shard in shards:
+            for item in shard_func(production_rules, semantics_rules, shard, *args):
+                yield item
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    pool_options = {}
+    rules = None
+    if sys.version_info >= (3, 7):
+        pool_options = dict(initializer=_init_shard_worker, initargs=(production_rules, semantics_rules))
+    else:
+        # Pool initializers need Python 3.7. Before that, the rules go out with every shard
+        rules = (production_rules, semantics_rules)
+    with ProcessPoolExecutor(max_workers=processes, **pool_options) as pool:
+        # Results come back in submission order, which keeps the merge deterministic
+        for result in pool.map(_run_shard_in_worker, [shard_func] * len(shards), [rules] * len(shards), shards,
+                               *[[arg] * len(shards) for arg in args]):
+            for item in result:
+                yield item
+
+
+# The rules a pool worker enumerates over. Set once per worker process instead of being sent with every shard
+_shard_rules = None
+
+
+def _init_shard_worker(production_rules, semantics_rules):
+    global _shard_rules
+    _shard_rules = (production_rules, semantics_rules)
+
+
+def _run_shard_in_worker(shard_func, rules, shard, *args):
+    production_rules, semantics_rules = rules if rules is not None else _shard_rules
+    return shard_func(production_rules, semantics_rules, shard, *args)
+
+
+def _expand_semantics_shard(production_rules, semantics_rules, utterance, keep_trees):
+    results = []
+    for command, parse in generate_sentence_parse_pairs(utterance, production_rules, semantics_rules, False):
         if has_placeholders(command) or has_placeholders(parse):
             # This case is almost certainly a bug with the annotations
             print("Skipping pair for {} because it still has placeholders after expansion".format(
                 tree_printer(command)))
             continue
-        # If it's important that we only get pairs that are in the grammar, check to make sure
-        if only_in_grammar and not command in all_utterances_in_grammar:
-            continue
-        out[tree_printer(command)] = tree_printer(parse)
-    return out
\ No newline at end of file
+        results.append((command if keep_trees else None, render(command), render(parse)))
+    return results
+
+
+def _expand_production_shard(production_rules, _, index, start_symbol):
+    production = production_rules[start_symbol][index]
+    return [tuple(sentence.children) for sentence in generate_sentences(production, production_rules)]
@@ -1,15 +1,22 @@
+import hashlib
 import os
+import sys
+import threading
+import time
 
+import lark
 from lark import Lark, Tree, exceptions
 
+from gpsr_command_understanding.compiled_grammar import CompiledGrammar
 from gpsr_command_understanding.generation import generate_sentence_parse_pairs, generate_sentence_slot_pairs, \
     expand_pair_full
 from gpsr_command_understanding.grammar import TypeConverter, expand_shorthand, CombineExpressions, \
     make_anonymized_grounding_rules
 from gpsr_command_understanding.util import get_wildcards, has_placeholders, merge_dicts
 from gpsr_command_understanding.tokens import NonTerminal, WildCard, Anonymized, ROOT_SYMBOL
-from gpsr_command_understanding.grammar import tree_printer
+from gpsr_command_understanding.grammar import render
 from gpsr_command_understanding.loading_helpers import load_wildcard_rules
+from gpsr_command_understanding.semantics import SemanticsRules
 
 try:
     from itertools import izip_longest as zip_longest
@@ -22,22 +29,63 @@ GENERATOR_GRAMMARS={2018:os.path.abspath(os.path.dirname(__file__) + "/../resour
 SEMANTIC_FORMS={"lambda": os.path.abspath(os.path.dirname(__file__) + "/../resources/lambda_ebnf.txt"),
                 "slot": os.path.abspath(os.path.dirname(__file__) + "/../resources/slot_ebnf.txt")}
 
+# Compiled LALR tables are pickled here so that only the first Generator pays for building them.
+# Set GPSR_PARSER_CACHE_DIR to another directory, or to an empty string to disable the cache.
+PARSER_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gpsr_command_understanding")
+
+
+def get_parser_cache_path(grammar_spec, start, cache_dir=None):
+    """
+    :param grammar_spec: the text of an EBNF grammar
+    :param start: the start rule the parser will be built for
+    :param cache_dir: directory to keep cached parsers in. Defaults to $GPSR_PARSER_CACHE_DIR or PARSER_CACHE_DIR
+    :return: path of the cache file for this grammar, or None if caching is disabled
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get("GPSR_PARSER_CACHE_DIR", PARSER_CACHE_DIR)
+    if not cache_dir:
+        return None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        # Read-only home directories shouldn't stop anyone from parsing
+        return None
+    key = hashlib.sha256(grammar_spec.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, "lark_{}_{}_{}_py{}{}.pickle".format(start, key, lark.__version__,
+                                                                      *sys.version_info[:2]))
+
+
+def make_parser(grammar_spec, start, cache_dir=None):
+    """
+    Builds an LALR parser for the grammar, loading the parse tables from the on-disk cache when possible.
+    Lark stores a hash of the grammar and options alongside the tables, so stale entries get rebuilt.
+    """
+    cache_path = get_parser_cache_path(grammar_spec, start, cache_dir)
+    return Lark(grammar_spec, start=start, parser="lalr", transformer=TypeConverter(),
+                cache=cache_path if cache_path else False)
+
 
 class Generator:
-    def __init__(self, grammar_format_version=2018, semantic_form_version="lambda"):
+    def __init__(self, grammar_format_version=2018, semantic_form_version="lambda", parser_cache_dir=None):
         with  open(GENERATOR_GRAMMARS[grammar_format_version]) as grammar_spec, open(SEMANTIC_FORMS[semantic_form_version]) as annotation_spec:
             grammar_spec = grammar_spec.read()
             annotation_spec = annotation_spec.read()
-        self.generator_grammar_parser = Lark(grammar_spec,
-                                             start='rule_start', parser="lalr", transformer=TypeConverter())
-        self.generator_sequence_parser = Lark(grammar_spec,
-                                              start='expression_start', parser="lalr", transformer=TypeConverter())
-        self.lambda_parser = Lark(annotation_spec,
-                         start='start', parser="lalr", transformer=TypeConverter())
+        self.generator_grammar_parser = make_parser(grammar_spec, 'rule_start', parser_cache_dir)
+        self.generator_sequence_parser = make_parser(grammar_spec, 'expression_start', parser_cache_dir)
+        self.lambda_parser = make_parser(annotation_spec, 'start', parser_cache_dir)
+        self.grammar_format_version = grammar_format_version
         self.semantic_form_version = semantic_form_version
         self.rules = []
+        # rule set index -> (grounded rules, semantics, CompiledGrammar) for count and pair_at
+        self._compiled_rule_sets = {}
+        # (absolute path, expand flag) -> ((size, mtime), [(lhs, productions)...]) for every grammar file loaded so far
+        self._rule_file_cache = {}
+        # Set on the instances handed out by get_generator, which are shared by everybody in the process
+        self.read_only = False
 
     def load_set_of_rules(self, grammar_file_paths, semantics_file_paths, objects_xml_file, locations_xml_file, names_xml_file, gestures_xml_file):
+        if self.read_only:
+            raise RuntimeError("This Generator is shared through get_generator. Construct your own to load rule sets into it")
         rules_raw = self.load_rules(grammar_file_paths)
         rules_anon = self.prepare_anonymized_rules(grammar_file_paths)
         rules_ground = self.prepare_grounded_rules(grammar_file_paths, objects_xml_file, locations_xml_file, names_xml_file, gestures_xml_file)
@@ -70,23 +118,42 @@ class Generator:
             grammar_file_paths = [grammar_file_paths]
         production_rules = {}
         for grammar_file_path in grammar_file_paths:
-            # TODO: Figure out why generator files have a byte order mark (BOM)
-            with open(grammar_file_path, encoding="utf-8-sig") as f:
-                for line in f:
-                    line = line.strip()
-                    # parse into possible productions
-                    lhs, rhs_productions = self.parse_production_rule(line, expand_shorthand)
-                    # Skip emtpy LHS (comments)
-                    # add to dictionary, if already there then append to list of rules
-                    # using set to avoid duplicates
-                    if not lhs:
-                        continue
-                    elif lhs not in production_rules:
-                        production_rules[lhs] = rhs_productions
-                    else:
-                        production_rules[lhs].extend(rhs_productions)
+            # Production trees are never modified once parsed, so they're shared with the cache. The lists holding
+            # them are the caller's own to extend, reorder or shuffle
+            for lhs, rhs_productions in self.load_rule_file(grammar_file_path, expand_shorthand):
+                # add to dictionary, if already there then append to list of rules
+                if lhs not in production_rules:
+                    production_rules[lhs] = list(rhs_productions)
+                else:
+                    production_rules[lhs].extend(rhs_productions)
         return production_rules
 
+    def load_rule_file(self, grammar_file_path, expand_shorthand=True):
+        """
+        Parses a single grammar file, memoized on the file's path, size and modification time.
+        :return: list of (NonTerminal, list of productions) in file order. Shared; don't modify it
+        """
+        key = (os.path.abspath(grammar_file_path), expand_shorthand)
+        stat = os.stat(grammar_file_path)
+        version = (stat.st_size, stat.st_mtime_ns)
+        cached = self._rule_file_cache.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        parsed_rules = []
+        # TODO: Figure out why generator files have a byte order mark (BOM)
+        with open(grammar_file_path, encoding="utf-8-sig") as f:
+            for line in f:
+                line = line.strip()
+                # parse into possible productions
+                lhs, rhs_productions = self.parse_production_rule(line, expand_shorthand)
+                # Skip emtpy LHS (comments)
+                if not lhs:
+                    continue
+                parsed_rules.append((lhs, rhs_productions))
+        self._rule_file_cache[key] = (version, parsed_rules)
+        return parsed_rules
+
     def parse_rule(self, line, rule_dict):
         # Probably a comment line
         if "=" not in line:
@@ -134,7 +201,7 @@ class Generator:
 
         if isinstance(semantics_file_paths, str):
             semantics_file_paths = [semantics_file_paths]
-        prod_to_semantics = {}
+        prod_to_semantics = SemanticsRules()
         for semantics_file_path in semantics_file_paths:
             with open(semantics_file_path) as f:
                 for line in f:
@@ -143,11 +210,11 @@ class Generator:
 
         return prod_to_semantics
 
-    def prepare_grounded_rules(self, grammar_file_paths, entities):
+    def prepare_grounded_rules(self, grammar_file_paths, entities, expand_shorthand=True):
 
         if not isinstance(grammar_file_paths, list):
             grammar_file_paths = [grammar_file_paths]
-        rules = self.load_rules(grammar_file_paths)
+        rules = self.load_rules(grammar_file_paths, expand_shorthand=expand_shorthand)
         grounding_rules = load_wildcard_rules(*entities)
 
         # This part of the grammar won't lend itself to any useful generalization from rephrasings
@@ -155,11 +222,11 @@ class Generator:
         rules[WildCard("pron")] = [Tree("expression",["them"])]
         return merge_dicts(rules, grounding_rules)
 
-    def prepare_anonymized_rules(self, grammar_file_paths, show_debug_details=False):
+    def prepare_anonymized_rules(self, grammar_file_paths, show_debug_details=False, expand_shorthand=True):
 
         if not isinstance(grammar_file_paths, list):
             grammar_file_paths = [grammar_file_paths]
-        rules = self.load_rules(grammar_file_paths)
+        rules = self.load_rules(grammar_file_paths, expand_shorthand=expand_shorthand)
 
         all_rule_trees = [tree for _, trees in rules.items() for tree in trees ]
         groundable_terms = get_wildcards(all_rule_trees)
@@ -172,45 +239,138 @@ class Generator:
         grounding_rules[WildCard("pron")] = [Tree("expression", ["them"])]
         return merge_dicts(rules, grounding_rules)
 
-    def get_utterance_semantics_pairs(self, random_source, rule_sets, branch_cap=None):
+    def get_utterance_semantics_pairs(self, random_source, rule_sets, branch_cap=None, max_pairs=None, time_limit=None, cancel=None):
+        """
+        :param max_pairs: most pairs to generate from each rule set
+        :param time_limit: seconds the whole call may take. Whatever was generated by then is returned
+        :param cancel: function called between expansions. Returns what was generated so far once it returns true
+        """
         all_pairs = {}
         rules = [self.rules[index - 1] for index in rule_sets]
+        deadline = time.monotonic() + time_limit if time_limit is not None else None
 
         for rules, rules_anon, rules_ground, semantics in rules:
             cat_groundings = {}
+            remaining_time = None
+            if deadline is not None:
+                remaining_time = deadline - time.monotonic()
+                if remaining_time <= 0:
+                    break
 
             pairs = []
             if self.semantic_form_version == "slot":
                 pairs = generate_sentence_slot_pairs(ROOT_SYMBOL, rules_ground, semantics,
                                                 yield_requires_semantics=True,
                                                 branch_cap=branch_cap,
-                                                random_generator=random_source)
+                                                random_generator=random_source,
+                                                max_pairs=max_pairs, time_limit=remaining_time, cancel=cancel)
             else:
                 pairs = generate_sentence_parse_pairs(ROOT_SYMBOL, rules_ground, semantics,
                                                 yield_requires_semantics=True,
                                                 branch_cap=branch_cap,
-                                                random_generator=random_source)
+                                                random_generator=random_source,
+                                                max_pairs=max_pairs, time_limit=remaining_time, cancel=cancel)
 
             for utterance, parse in pairs:
-                all_pairs[tree_printer(utterance)] = tree_printer(parse)
+                all_pairs[render(utterance)] = render(parse)
             #for sentence, semantics in pairs:
             #    print(tree_printer(sentence))
             #    print(tree_printer(semantics))
         return all_pairs
 
+    def count(self, rule_sets):
+        """
+        :param rule_sets: 1-based indices into self.rules, as for get_utterance_semantics_pairs
+        :return: how many grounded pairs the rule sets can produce. pair_at accepts indices in [0, count)
+        """
+        return sum(self.get_compiled_rule_set(index).pair_count() for index in rule_sets)
 
-def get_grounding_per_each_parse(generator, random_source):
+    def pair_at(self, index, rule_sets):
+        """
+        Fetch one grounded (utterance, parse) pair by index, without generating the ones before it. Indices run
+        through the rule sets in the order given, so drawing distinct indices samples without replacement.
+        :return: (utterance, parse) Trees, or None if that derivation's annotation is broken
+        """
+        remaining = index
+        if remaining >= 0:
+            for rule_set in rule_sets:
+                compiled = self.get_compiled_rule_set(rule_set)
+                if remaining < compiled.pair_count():
+                    return compiled.pair_at(remaining)
+                remaining -= compiled.pair_count()
+        raise IndexError("Pair index {} out of range".format(index))
+
+    def get_compiled_rule_set(self, index):
+        """
+        :param index: 1-based index into self.rules
+        :return: the CompiledGrammar for that rule set's grounded rules, compiled once and reused
+        """
+        if self.semantic_form_version != "lambda":
+            raise ValueError("Random access is only available for lambda semantics, not {}".format(
+                self.semantic_form_version))
+        _, _, rules_ground, semantics = self.rules[index - 1]
+        cached = self._compiled_rule_sets.get(index)
+        if not cached or cached[0] is not rules_ground or cached[1] is not semantics:
+            cached = (rules_ground, semantics, CompiledGrammar(rules_ground, semantics))
+            self._compiled_rule_sets[index] = cached
+        return cached[2]
+
+
+_shared_generators = {}
+_shared_generators_lock = threading.Lock()
+
+
+def get_generator(grammar_format_version=2018, semantic_form_version="lambda"):
+    """
+    Hands out one Generator per (grammar_format_version, semantic_form_version) for the whole process, so that
+    models, metrics and scripts don't each rebuild identical LALR tables. The instance is shared; don't mutate it.
+    """
+    key = (grammar_format_version, semantic_form_version)
+    with _shared_generators_lock:
+        generator = _shared_generators.get(key)
+        if generator is None:
+            generator = Generator(grammar_format_version, semantic_form_version)
+            generator.read_only = True
+            _shared_generators[key] = generator
+    return generator
+
+
+def get_lambda_parser(semantic_form_version="lambda"):
+    """
+    :return: the shared parser for the semantic form (lambda calculus or slot annotations)
+    """
+    return get_generator(semantic_form_version=semantic_form_version).lambda_parser
+
+
+def _wild_expansions(cat_index, generation_path, rules, semantics, random_source, wild_cache=None):
+    # The wildcard-level expansions don't change between grounding passes, only their grounding does. Entries keep
+    # the rules they came from, so a category whose rules were replaced is expanded again
+    key = (cat_index, generation_path)
+    cached = wild_cache.get(key) if wild_cache is not None else None
+    if cached and cached[0] is rules and cached[1] is semantics:
+        return list(cached[2])
+    wild_expansions = list(generate_sentence_parse_pairs(generation_path, rules, semantics,
+                                                         yield_requires_semantics=True,
+                                                         random_generator=random_source))
+    if wild_cache is not None:
+        wild_cache[key] = (rules, semantics, tuple(wild_expansions))
+    return wild_expansions
+
+
+def get_grounding_per_each_parse(generator, random_source, wild_cache=None):
+    """
+    :param wild_cache: optional dict that remembers the wildcard-level expansions, so repeated grounding passes
+        that share it only pay for the enumeration once
+    """
     grounded_examples = {}
 
-    for rules, rules_anon, rules_ground, semantics in generator:
+    for i, (rules, rules_anon, rules_ground, semantics) in enumerate(generator):
         # Start with each rule, since this is guaranteed to get at least all possible parses
         # Note, this may include parses that don't fall in the grammar...
         for generation_path, semantic_production in semantics.items():
             # Some non-terminals may expand into different parses (like $oprop)! So we'll expand them
             # every which way
-            wild_expansions = list(generate_sentence_parse_pairs(generation_path, rules, semantics,
-                                                                 yield_requires_semantics=True,
-                                                                 random_generator=random_source))
+            wild_expansions = _wild_expansions(i, generation_path, rules, semantics, random_source, wild_cache)
             # We're going to be throwing away expansions that have the same parse, so let's
             # randomize here to make sure we aren't favoring the last expansion.
             # Note that the above generation should also return expansions in a random order anyway
@@ -234,19 +394,21 @@ def get_grounding_per_each_parse(generator, random_source):
     return list(grounded_examples.values())
 
 
-def get_grounding_per_each_parse_by_cat(generator, random_source):
+def get_grounding_per_each_parse_by_cat(generator, random_source, wild_cache=None):
+    """
+    :param wild_cache: optional dict that remembers each category's wildcard-level expansions, so repeated
+        grounding passes that share it only pay for the enumeration once
+    """
     grounded_examples = []
 
-    for rules, rules_anon, rules_ground, semantics in generator:
+    for i, (rules, rules_anon, rules_ground, semantics) in enumerate(generator):
         cat_groundings = {}
         # Start with each rule, since this is guaranteed to get at least all possible parses
         # Note, this may include parses that don't fall in the grammar...
         for generation_path, semantic_production in semantics.items():
             # Some non-terminals may expand into different parses (like $oprop)! So we'll expand them
             # every which way
-            wild_expansions = list(generate_sentence_parse_pairs(generation_path, rules, semantics,
-                                                                 yield_requires_semantics=True,
-                                                                 random_generator=random_source))
+            wild_expansions = _wild_expansions(i, generation_path, rules, semantics, random_source, wild_cache)
             # We're going to be throwing away expansions that have the same parse, so let's
             # randomize here to make sure we aren't favoring the last expansion.
             # Note that the above generation should also return expansions in a random order anyway
@@ -1,8 +1,5 @@
-from copy import deepcopy
-
-from gpsr_command_understanding.util import replace_child
-
 from gpsr_command_understanding.tokens import *
+from gpsr_command_understanding.util import get_placeholders
 
 from lark import Tree, Transformer, Visitor
 
@@ -131,6 +128,30 @@ class ToString(Transformer):
 
 tree_printer = ToString()
 
+# Node types whose text isn't just their children's joined with spaces
+_special_renderers = {data: getattr(tree_printer, data) for data in
+                      ["non_terminal", "choice", "rule", "predicate", "slot_pred", "lambda_abs", "constant_placeholder"]}
+
+
+def render(tree):
+    """
+    Gives the same string as tree_printer, but joins each node's text in one go instead of going through a Transformer
+    """
+    children = [render(child) if isinstance(child, Tree) else child for child in tree.children]
+    special = _special_renderers.get(tree.data)
+    if special:
+        return special(children)
+    return " ".join([child if isinstance(child, str) else
+                     child.to_human_readable() if isinstance(child, WildCard) else str(child) for child in children])
+
+
+def render_all(trees):
+    """
+    :param trees: iterable of trees
+    :return: list of their strings, as render gives them
+    """
+    return [render(tree) for tree in trees]
+
 
 class CombineExpressions(Visitor):
     """
@@ -143,45 +164,166 @@ class CombineExpressions(Visitor):
         self.expression(tree)
 
     def expression(self, tree):
-        cleaned = []
-        i = 0
-        while i < len(tree.children):
-            child = tree.children[i]
-            # Not a fragment? Forward to output
-            if not (isinstance(child, Tree) and child.data == "expression"):
-                cleaned.append(child)
-                i += 1
-                continue
-            # Otherwise, gather up the the next subsequence of fragments
-            j = i + 1
-            while j < len(tree.children):
-                next_child = tree.children[j]
-                if isinstance(next_child, Tree) and next_child.data == "expression":
-                    j += 1
-                    continue
-                break
-            cleaned.extend([c for t in tree.children[i:j] for c in t.children])
-            i = j
-        if i == len(tree.children) - 1:
-            cleaned.append(tree.children[i])
-
-        all_expanded = False
-        while not all_expanded:
-            i = 0
-            while i < len(cleaned):
-                child = cleaned[i]
-                if isinstance(child, Tree) and child.data == "expression":
-                    cleaned = cleaned[:i] + child.children + cleaned[i+1:]
-                    break
-                i += 1
-            all_expanded = True
-        tree.children = cleaned
+        # Children are visited first, so their own fragments are already combined
+        tree.children = combine_fragments(tree.children)
+
+
+def combine_fragments(children):
+    """
+    Splices the children of any nested expressions into the list, in one pass.
+    :return: a new list with no expression children, assuming the nested expressions had none of their own
+    """
+    combined = []
+    for child in children:
+        if isinstance(child, Tree) and child.data == "expression":
+            combined.extend(child.children)
+        else:
+            combined.append(child)
+    return combined
+
+
+def is_void(token):
+    return (isinstance(token, WildCard) or isinstance(token, Anonymized)) and token.name == "void"
+
+
+def normalize_expressions(tree, memo=None):
+    """
+    Gives what running DiscardVoid and then CombineExpressions over the tree would, in one pass and without modifying
+    it. Subtrees that are already normalized are shared with the input.
+    """
+    if memo is None:
+        memo = {}
+    key = id(tree)
+    if key in memo:
+        return memo[key]
+    children = [normalize_expressions(child, memo) if isinstance(child, Tree) else child for child in tree.children]
+    data = tree.data
+    if data == "expression":
+        children = [child for child in children if not is_void(child)]
+    if data == "expression" or data == "top_expression":
+        data = "expression"
+        children = combine_fragments(children)
+    if data == tree.data and len(children) == len(tree.children) and all(
+            new is old for new, old in zip(children, tree.children)):
+        result = tree
+    else:
+        result = Tree(data, children)
+    memo[key] = result
+    return result
+
+
+def check_annotation(sentence, semantics, sentence_placeholders=None):
+    """
+    Warns about placeholders that don't line up between a finished sentence and its normalized semantics.
+    :param sentence_placeholders: the placeholders left in the sentence, if the caller already has them
+    :return: False if the semantics has placeholders the sentence will never fill, so the pair should be dropped
+    """
+    sem_placeholders_remaining = get_placeholders(semantics)
+    if sentence_placeholders is None:
+        sentence_placeholders = get_placeholders(sentence)
+    # Are there placeholders in the semantics that aren't left in the sentence? These will never get expanded,
+    # so it's almost certainly an error
+    probably_should_be_filled = sem_placeholders_remaining.difference(sentence_placeholders)
+    if len(probably_should_be_filled) > 0:
+        print("Unfilled placeholders {}".format(" ".join(map(str, probably_should_be_filled))))
+        print(tree_printer.transform(sentence))
+        print(tree_printer.transform(semantics))
+        print("This annotation is probably wrong")
+        print("")
+        return False
+    elif len(sem_placeholders_remaining) != len(sentence_placeholders):
+        not_in_annotation = sentence_placeholders.difference(sem_placeholders_remaining)
+        print("Annotation is missing wildcards that are present in the original sentence. Were they left out accidentally?")
+        print(" ".join(map(str, not_in_annotation)))
+        print(tree_printer.transform(sentence))
+        print(tree_printer.transform(semantics))
+        print("")
+    return True
+
+
+def count_reachable_derivations(symbol, children, count_symbol, counts, describe):
+    """
+    Counts the complete derivations of a symbol bottom-up, visiting only the symbols it can reach.
+    :param children: gives the expandable symbols a symbol's productions use
+    :param count_symbol: gives a symbol's count once everything it uses is in counts
+    :param counts: memo of counts so far. Filled in place
+    :param describe: gives a human-readable name for a symbol, for the recursion error
+    """
+    count = counts.get(symbol)
+    if count is not None:
+        return count
+    # Iterative post-order walk. Symbols on the current path are "in progress"; meeting one again is a cycle
+    in_progress = {symbol: 0}
+    path = [symbol]
+    stack = [(symbol, iter(children(symbol)))]
+    while stack:
+        current, remaining = stack[-1]
+        child = next(remaining, None)
+        if child is None:
+            stack.pop()
+            path.pop()
+            del in_progress[current]
+            counts[current] = count_symbol(current)
+        elif child not in counts:
+            if child in in_progress:
+                cycle = path[in_progress[child]:] + [child]
+                raise ValueError("Grammar has infinitely many derivations. Recursive rule: {}".format(
+                    " -> ".join(map(describe, cycle))))
+            in_progress[child] = len(path)
+            path.append(child)
+            stack.append((child, iter(children(child))))
+    return counts[symbol]
+
+
+def find_choice_path(tree):
+    """
+    Finds the first choice in a top-down, left-to-right walk of the tree.
+    :return: list of (parent, child index) pairs leading from the root to the choice, or None if there's no choice
+    """
+    stack = [(tree, [])]
+    while stack:
+        node, path = stack.pop()
+        if node.data == "choice":
+            return path
+        for i in reversed(range(len(node.children))):
+            child = node.children[i]
+            if isinstance(child, Tree):
+                stack.append((child, path + [(node, i)]))
+    return None
+
+
+def find_choice(tree):
+    """
+    Rules loaded with expand_shorthand=False keep their choices as lazy "choice" nodes. Generation makes them on demand.
+    :return: the outermost unmade choice in the tree, or None if there aren't any
+    """
+    path = find_choice_path(tree)
+    if path is None:
+        return None
+    if not path:
+        return tree
+    parent, i = path[-1]
+    return parent.children[i]
+
+
+def replace_at_path(path, replacement):
+    """
+    Copies only the spine of the tree from the root down to the node at the end of the path, swapping that node
+    for the replacement. Everything off of the spine is shared with the original tree.
+    :return: the new root
+    """
+    for parent, i in reversed(path):
+        children = list(parent.children)
+        children[i] = replacement
+        replacement = Tree(parent.data, children)
+    return replacement
 
 
 def expand_shorthand(tree):
     """
     A choice in a rule can be expanded into several different rules enumerating each combination of branch selections.
-    This makes each choice and returns the list of resulting expressions
+    This makes each choice and returns the list of resulting expressions. The results share any choice-free subtrees
+    with each other and with the input.
     :param tree:
     :return:
     """
@@ -190,29 +332,23 @@ def expand_shorthand(tree):
     combiner = CombineExpressions()
     while len(in_progress) != 0:
         current = in_progress.pop()
-        choice = None
         # Find the unmade choice that's furthest up the tree
-        for subtree in current.iter_subtrees_topdown():
-            if subtree.data == "choice":
-                choice = subtree
-                break
-        if not choice:
+        choice_path = find_choice_path(current)
+        if choice_path is None:
             # All choices expanded!
             # Choices will make a mess of unnecessarily nested expressions. Clean
             # up.
             combiner.visit(current)
             output.append(current)
             continue
-       # Make the choice in every way
-        for option in choice.children:
-            choice_made_tree = deepcopy(current)
-            # Is this choice the root of the tree? No parent in this case
-            if choice_made_tree == choice:
-                in_progress.append(option)
-            else:
-                choice_parent = list(choice_made_tree.find_pred(lambda subtree: any([child == choice for child in subtree.children])))[0]
-                replace_child(choice_parent, choice, option, only_once=True)
-                in_progress.append(choice_made_tree)
+        if not choice_path:
+            # The choice is the root of the tree, so each option stands on its own
+            in_progress.extend(current.children)
+            continue
+        parent, i = choice_path[-1]
+        # Make the choice in every way
+        for option in parent.children[i].children:
+            in_progress.append(replace_at_path(choice_path, option))
 
     return output
 
@@ -224,7 +360,8 @@ def make_anonymized_grounding_rules(wildcards, show_details=False):
     :return:
     """
     grounding_rules = {}
-    for wildcard in wildcards:
+    # Sets of wildcards iterate in hash order, which changes between processes
+    for wildcard in sorted(wildcards, key=str):
         if show_details:
             prod = Anonymized(wildcard.to_human_readable())
         else:
@@ -1,3 +1,6 @@
+import hashlib
+import os
+import pickle
 from os.path import join
 
 from lark import Tree
@@ -5,6 +8,81 @@ from lark import Tree
 from gpsr_command_understanding.tokens import WildCard
 from gpsr_command_understanding.xml_parsers import ObjectParser, LocationParser, NameParser, GesturesParser
 
+# Fully loaded rule sets are pickled here, keyed by the content of every file that went into them and of the code
+# that loaded them. Set GPSR_SNAPSHOT_CACHE_DIR to another directory, or to an empty string to disable snapshots.
+SNAPSHOT_CACHE_DIR = join(os.path.expanduser("~"), ".cache", "gpsr_command_understanding")
+# Bump when the layout of the pickled data changes. Changes to the loading code invalidate snapshots on their own
+SNAPSHOT_FORMAT_VERSION = 3
+# Modules whose code decides what a loaded rule set looks like
+SNAPSHOT_SOURCE_MODULES = ["loading_helpers", "generator", "grammar", "tokens", "semantics", "util", "xml_parsers"]
+
+_source_code_hash = None
+
+
+def hash_files(paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+        # Make sure moving content between files changes the hash
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def get_source_code_hash():
+    """
+    :return: hash of the package modules that loading runs through
+    """
+    global _source_code_hash
+    if _source_code_hash is None:
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        _source_code_hash = hash_files([join(package_dir, module + ".py") for module in SNAPSHOT_SOURCE_MODULES])
+    return _source_code_hash
+
+
+def get_snapshot_path(name, source_paths, generator, cache_dir=None):
+    """
+    :param name: what's being snapshotted
+    :param source_paths: every file the snapshot's content was derived from
+    :param generator: the Generator doing the loading. Its grammars are part of the key
+    :return: path to the snapshot file, or None if snapshots are disabled
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get("GPSR_SNAPSHOT_CACHE_DIR", SNAPSHOT_CACHE_DIR)
+    if not cache_dir:
+        return None
+    # Imported here because generator depends on this module
+    from gpsr_command_understanding.generator import GENERATOR_GRAMMARS, SEMANTIC_FORMS
+    source_paths = list(source_paths) + [GENERATOR_GRAMMARS[generator.grammar_format_version],
+                                         SEMANTIC_FORMS[generator.semantic_form_version]]
+    key = hashlib.sha256((hash_files(source_paths) + get_source_code_hash()).encode()).hexdigest()[:16]
+    return join(cache_dir, "{}_v{}_{}.pickle".format(name, SNAPSHOT_FORMAT_VERSION, key))
+
+
+def load_snapshot(snapshot_path):
+    if not snapshot_path or not os.path.isfile(snapshot_path):
+        return None
+    try:
+        with open(snapshot_path, "rb") as f:
+            return pickle.load(f)
+    except Exception as e:
+        print("Ignoring unreadable snapshot {}: {}".format(snapshot_path, e))
+        return None
+
+
+def save_snapshot(snapshot_path, data):
+    if not snapshot_path:
+        return
+    try:
+        os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+        # Write then rename so concurrent runs never see a partial file
+        tmp_path = "{}.{}.tmp".format(snapshot_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, snapshot_path)
+    except OSError as e:
+        print("Couldn't save snapshot {}: {}".format(snapshot_path, e))
+
 
 def load_entities_from_xml(objects_xml_file, locations_xml_file, names_xml_file, gestures_xml_file):
     object_parser = ObjectParser(objects_xml_file)
@@ -87,61 +165,122 @@ def load_wildcard_rules(objects, categories, names, locations, beacons, placemen
     return production_rules
 
 
-def load_all_2018_by_cat(generator, grammar_dir, expand_shorthand=True):
-
-    common_path = join(grammar_dir, "common_rules.txt")
-
-    paths = tuple(map(lambda x: join(grammar_dir, x), ["objects.xml", "locations.xml", "names.xml", "gestures.xml"]))
-    entities = load_entities_from_xml(*paths)
-
-    cat1_rules = generator.load_rules([common_path, join(grammar_dir, "gpsr_category_1_grammar.txt")])
-    cat2_rules = generator.load_rules([common_path, join(grammar_dir, "gpsr_category_2_grammar.txt")])
-    cat3_rules = generator.load_rules([common_path, join(grammar_dir, "gpsr_category_3_grammar.txt")])
-
-    cat1_rules_ground = generator.prepare_grounded_rules([common_path, join(grammar_dir, "gpsr_category_1_grammar.txt")], entities)
-    cat2_rules_ground = generator.prepare_grounded_rules([common_path, join(grammar_dir, "gpsr_category_2_grammar.txt")], entities)
-    cat3_rules_ground = generator.prepare_grounded_rules([common_path, join(grammar_dir, "gpsr_category_3_grammar.txt")], entities)
-    cat1_rules_anon = generator.prepare_anonymized_rules([common_path, join(grammar_dir, "gpsr_category_1_grammar.txt")])
-    cat2_rules_anon = generator.prepare_anonymized_rules([common_path, join(grammar_dir, "gpsr_category_2_grammar.txt")])
-    cat3_rules_anon = generator.prepare_anonymized_rules([common_path, join(grammar_dir, "gpsr_category_3_grammar.txt")])
+def run_load_task(generator, task, entity_cache=None):
+    """
+    Runs one independent unit of loading work.
+    :param task: tuple of a kind ("rules", "anonymized", "grounded", "semantics" or "entities") followed by its arguments
+    :param entity_cache: dict from entity file paths to their loaded entities, shared by tasks run in the same process
+    """
+    kind, args = task[0], task[1:]
+    if kind == "rules":
+        grammar_paths, expand_shorthand = args
+        return generator.load_rules(grammar_paths, expand_shorthand=expand_shorthand)
+    elif kind == "anonymized":
+        grammar_paths, expand_shorthand = args
+        return generator.prepare_anonymized_rules(grammar_paths, expand_shorthand=expand_shorthand)
+    elif kind == "grounded":
+        grammar_paths, entity_paths, expand_shorthand = args
+        return generator.prepare_grounded_rules(grammar_paths, _load_entities(entity_paths, entity_cache),
+                                                expand_shorthand=expand_shorthand)
+    elif kind == "semantics":
+        semantics_paths, = args
+        return generator.load_semantics_rules(semantics_paths)
+    elif kind == "entities":
+        return _load_entities(args[0], entity_cache)
+    raise ValueError("Unknown load task {}".format(kind))
+
+
+def _load_entities(entity_paths, entity_cache=None):
+    if entity_cache is None:
+        return load_entities_from_xml(*entity_paths)
+    if entity_paths not in entity_cache:
+        entity_cache[entity_paths] = load_entities_from_xml(*entity_paths)
+    return entity_cache[entity_paths]
+
+
+def _run_load_task_in_worker(grammar_format_version, semantic_form_version, task):
+    # Imported here because generator depends on this module
+    from gpsr_command_understanding.generator import get_generator
+    return run_load_task(get_generator(grammar_format_version, semantic_form_version), task)
+
+
+def run_load_tasks(generator, tasks, processes=None):
+    """
+    Runs the tasks, in a process pool if processes is more than 1.
+    :return: list of the task results, in the same order as the tasks
+    """
+    if not processes or processes <= 1:
+        # Every category grounds against the same entity files, so only read them once
+        entity_cache = {}
+        return [run_load_task(generator, task, entity_cache) for task in tasks]
 
-    cat1_semantics = generator.load_semantics_rules(join(grammar_dir, "gpsr_category_1_semantics.txt"))
-    cat2_semantics = generator.load_semantics_rules(
-        [join(grammar_dir, "gpsr_category_1_semantics.txt"), join(grammar_dir, "gpsr_category_2_semantics.txt")])
-    cat3_semantics = generator.load_semantics_rules(join(grammar_dir, "gpsr_category_3_semantics.txt"))
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        # Workers construct their own Generator, so we only need to say which grammars it should use
+        futures = [pool.submit(_run_load_task_in_worker, generator.grammar_format_version,
+                               generator.semantic_form_version, task) for task in tasks]
+        return [future.result() for future in futures]
 
-    return [(cat1_rules, cat1_rules_anon, cat1_rules_ground, cat1_semantics), (cat2_rules, cat2_rules_anon, cat2_rules_ground, cat2_semantics), (cat3_rules, cat3_rules_anon, cat3_rules_ground, cat3_semantics)]
 
+def load_all_2018_by_cat(generator, grammar_dir, expand_shorthand=True, snapshot_dir=None, processes=None):
+    """
+    Loads the rules, anonymized rules, grounded rules and semantics for each of the three 2018 categories.
+    Results are snapshotted to disk and reused until any of the source files change.
+    :param expand_shorthand: if false, choices are left in the rules as lazy choice nodes
+    :param snapshot_dir: where to keep snapshots. Defaults to $GPSR_SNAPSHOT_CACHE_DIR or SNAPSHOT_CACHE_DIR,
+        empty string disables
+    :param processes: number of worker processes to spread the loading across. Loads in this process by default
+    """
+    common_path = join(grammar_dir, "common_rules.txt")
 
-def load_all_2018(generator, grammar_dir, expand_shorthand=True):
+    paths = tuple(map(lambda x: join(grammar_dir, x), ["objects.xml", "locations.xml", "names.xml", "gestures.xml"]))
+    source_paths = [common_path] + [join(grammar_dir, "gpsr_category_{}_{}.txt".format(cat, kind)) for kind in
+                                    ["grammar", "semantics"] for cat in range(1, 4)] + list(paths)
+    snapshot_name = "2018_by_cat" if expand_shorthand else "2018_by_cat_lazy"
+    snapshot_path = get_snapshot_path(snapshot_name, source_paths, generator, snapshot_dir)
+    snapshot = load_snapshot(snapshot_path)
+    if snapshot is not None:
+        return snapshot
+
+    cat_grammar_paths = [[common_path, join(grammar_dir, "gpsr_category_{}_grammar.txt".format(cat))] for cat in range(1, 4)]
+    cat_semantics_paths = [[join(grammar_dir, "gpsr_category_1_semantics.txt")],
+                           [join(grammar_dir, "gpsr_category_1_semantics.txt"), join(grammar_dir, "gpsr_category_2_semantics.txt")],
+                           [join(grammar_dir, "gpsr_category_3_semantics.txt")]]
+    tasks = []
+    for grammar_paths, semantics_paths in zip(cat_grammar_paths, cat_semantics_paths):
+        tasks += [("rules", grammar_paths, expand_shorthand), ("anonymized", grammar_paths, expand_shorthand),
+                  ("grounded", grammar_paths, paths, expand_shorthand), ("semantics", semantics_paths)]
+    results = run_load_tasks(generator, tasks, processes)
+
+    loaded = [tuple(results[i:i + 4]) for i in range(0, len(results), 4)]
+    save_snapshot(snapshot_path, loaded)
+    return loaded
+
+
+def load_all_2018(generator, grammar_dir, expand_shorthand=True, processes=None):
 
     common_path = join(grammar_dir, "common_rules.txt")
 
     paths = tuple(map(lambda x: join(grammar_dir, x), ["objects.xml", "locations.xml", "names.xml", "gestures.xml"]))
-    entities = load_entities_from_xml(*paths)
     grammar_files = [common_path, join(grammar_dir, "gpsr_category_1_grammar.txt"), join(grammar_dir, "gpsr_category_2_grammar.txt"), join(grammar_dir, "gpsr_category_3_grammar.txt")]
-    rules = generator.load_rules(grammar_files)
-
-    rules_ground = generator.prepare_grounded_rules(grammar_files, entities)
-    rules_anon = generator.prepare_anonymized_rules(grammar_files)
-
-    semantics = generator.load_semantics_rules(
-        [join(grammar_dir, "gpsr_category_1_semantics.txt"), join(grammar_dir, "gpsr_category_2_semantics.txt"),  join(grammar_dir, "gpsr_category_3_semantics.txt")])
+    semantics_files = [join(grammar_dir, "gpsr_category_1_semantics.txt"), join(grammar_dir, "gpsr_category_2_semantics.txt"),  join(grammar_dir, "gpsr_category_3_semantics.txt")]
 
+    rules, rules_anon, rules_ground, semantics, entities = run_load_tasks(generator, [
+        ("rules", grammar_files, expand_shorthand), ("anonymized", grammar_files, expand_shorthand),
+        ("grounded", grammar_files, paths, expand_shorthand), ("semantics", semantics_files), ("entities", paths)],
+                                                                          processes)
     return rules, rules_anon, rules_ground, semantics, entities
 
 
-def load_all_2019(generator, grammar_dir, expand_shorthand=True):
+def load_all_2019(generator, grammar_dir, expand_shorthand=True, processes=None):
 
     common_path = join(grammar_dir, "common_rules.txt")
 
     paths = tuple(map(lambda x: join(grammar_dir, x), ["objects.xml", "locations.xml", "names.xml", "gestures.xml"]))
-    entities = load_entities_from_xml(*paths)
+    grammar_files = [common_path, join(grammar_dir, "gpsr.txt")]
 
-    rules = generator.load_rules([common_path, join(grammar_dir, "gpsr.txt")], expand_shorthand=expand_shorthand)
-    rules_ground = generator.prepare_grounded_rules([common_path, join(grammar_dir, "gpsr.txt")], entities)
-    rules_anon = generator.prepare_anonymized_rules([common_path, join(grammar_dir, "gpsr.txt")])
-
-    semantics = generator.load_semantics_rules(join(grammar_dir, "gpsr_semantics.txt"))
-
-    return rules, rules_anon, rules_ground, semantics, entities
\ No newline at end of file
+    rules, rules_anon, rules_ground, semantics, entities = run_load_tasks(generator, [
+        ("rules", grammar_files, expand_shorthand), ("anonymized", grammar_files, expand_shorthand),
+        ("grounded", grammar_files, paths, expand_shorthand), ("semantics", join(grammar_dir, "gpsr_semantics.txt")),
+        ("entities", paths)], processes)
+    return rules, rules_anon, rules_ground, semantics, entities
@@ -20,7 +20,7 @@ from allennlp.nn import util
 from allennlp.nn.beam_search import BeamSearch
 from allennlp.training.metrics import BLEU
 
-from gpsr_command_understanding.generator import Generator
+from gpsr_command_understanding.generator import get_lambda_parser
 from gpsr_command_understanding.models.metrics import TokenSequenceAccuracy, ParseValidity
 
 
@@ -100,7 +100,7 @@ class Seq2Seq(Model):
         else:
             self._bleu = None
 
-        self._token_based_metrics = [TokenSequenceAccuracy(), ParseValidity(Generator(semantic_form_version="slot").lambda_parser)]
+        self._token_based_metrics = [TokenSequenceAccuracy(), ParseValidity(get_lambda_parser(semantic_form_version="slot"))]
 
         # At prediction time, we use a beam search to find the most likely sequence of target tokens.
         beam_size = beam_size or 1
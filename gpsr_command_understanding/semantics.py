@@ -4,3 +4,94 @@ from lark import Lark, Tree
 
 from gpsr_command_understanding.grammar import expand_shorthand, TypeConverter
 from gpsr_command_understanding.util import get_wildcards
+
+
+def utterance_signature(utterance):
+    """
+    Utterances are flat expressions once their shorthand and nested fragments have been cleaned up, so the sequence
+    of their symbols identifies them. Hashing that sequence doesn't need to recurse through the tree.
+    :return: tuple of the utterance's symbols, or None if the utterance isn't flat
+    """
+    if not isinstance(utterance, Tree) or utterance.data != "expression":
+        return None
+    children = utterance.children
+    for child in children:
+        if isinstance(child, Tree):
+            return None
+    return tuple(children)
+
+
+class SemanticsRules(dict):
+    """
+    Maps utterance templates to semantic templates, like the plain dictionaries we used to use. Also indexes
+    the rules by utterance_signature so generation can look up semantics for a flat utterance cheaply.
+    """
+    def __init__(self, *args, **kwargs):
+        super(SemanticsRules, self).__init__()
+        self.by_signature = {}
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, utterance, semantics):
+        super(SemanticsRules, self).__setitem__(utterance, semantics)
+        signature = utterance_signature(utterance)
+        if signature is not None:
+            self.by_signature[signature] = semantics
+
+    def __delitem__(self, utterance):
+        super(SemanticsRules, self).__delitem__(utterance)
+        self.by_signature.pop(utterance_signature(utterance), None)
+
+    def update(self, *args, **kwargs):
+        for utterance, semantics in dict(*args, **kwargs).items():
+            self[utterance] = semantics
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def setdefault(self, utterance, semantics=None):
+        if utterance not in self:
+            self[utterance] = semantics
+        return self[utterance]
+
+    def pop(self, utterance, *default):
+        if utterance not in self:
+            if default:
+                return default[0]
+            raise KeyError(utterance)
+        semantics = self[utterance]
+        del self[utterance]
+        return semantics
+
+    def popitem(self):
+        utterance, semantics = super(SemanticsRules, self).popitem()
+        self.by_signature.pop(utterance_signature(utterance), None)
+        return utterance, semantics
+
+    def clear(self):
+        super(SemanticsRules, self).clear()
+        self.by_signature.clear()
+
+    def lookup(self, utterance, signature=None):
+        """
+        :param signature: the utterance's signature, if the caller has already computed it
+        :return: the semantics for the utterance, or None
+        """
+        if signature is None:
+            signature = utterance_signature(utterance)
+        if signature is None:
+            return self.get(utterance)
+        return self.by_signature.get(signature)
+
+    def __reduce__(self):
+        # Rebuild through __setitem__ so the index comes back with the rules
+        return self.__class__, (list(self.items()),)
+
+
+def lookup_semantics(semantics_rules, utterance):
+    """
+    Look up semantics in either a SemanticsRules or a plain dictionary
+    """
+    if isinstance(semantics_rules, SemanticsRules):
+        return semantics_rules.lookup(utterance)
+    return semantics_rules.get(utterance)
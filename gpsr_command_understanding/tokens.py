@@ -1,17 +1,66 @@
 # coding: utf-8
 
+# Every distinct token is constructed once and shared from then on. Keyed on (class, constructor arguments)
+_interned = {}
+
+
+def _intern(cls, key, **attributes):
+    key = (cls,) + key
+    instance = _interned.get(key)
+    if instance is None:
+        instance = object.__new__(cls)
+        for name, value in attributes.items():
+            object.__setattr__(instance, name, value)
+        # Generation hashes tokens constantly, so only pay for formatting the string once
+        object.__setattr__(instance, "_hash", hash(instance.__str__()))
+        instance = _interned.setdefault(key, instance)
+    return instance
+
+
+class Immutable(object):
+    """
+    Interned tokens are shared by every tree that mentions them, so they can't be changed after construction.
+    Copies are the token itself.
+    """
+    __slots__ = ()
+
+    def __setattr__(self, key, value):
+        raise AttributeError("{} is immutable".format(self.__class__.__name__))
+
+    def __delattr__(self, key):
+        raise AttributeError("{} is immutable".format(self.__class__.__name__))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __hash__(self):
+        return self._hash
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class NonTerminal(Immutable):
+    __slots__ = ("name", "_hash")
+
+    def __new__(cls, name):
+        name = str(name)
+        return _intern(cls, (name,), name=name)
+
+    def __reduce__(self):
+        return self.__class__, (self.name,)
 
-class NonTerminal(object):
-    def __init__(self, name):
-        self.name = name
     def to_human_readable(self):
         return "$" + self.name
     def __str__(self):
         return "NonTerminal({})".format(self.name)
     def __hash__(self):
-        return hash(self.__str__())
+        return self._hash
     def __eq__(self, other):
-        return isinstance(other, NonTerminal) and self.name == other.name
+        return self is other or (isinstance(other, NonTerminal) and self.name == other.name)
 
 
 class WildCard(NonTerminal):
@@ -19,11 +68,17 @@ class WildCard(NonTerminal):
     A nonterminal type representing some object, location, gesture, category, or name.
     Not fully modeled.
     """
-    def __init__(self, name, type=None, extra=None, obfuscated=False):
-        self.obfuscated = obfuscated
-        self.type = type.strip() if type else None
-        self.extra = extra.strip() if extra else None
-        super(WildCard, self).__init__(name)
+    __slots__ = ("type", "extra", "obfuscated")
+
+    def __new__(cls, name, type=None, extra=None, obfuscated=False):
+        name = str(name)
+        type = type.strip() if type else None
+        extra = extra.strip() if extra else None
+        obfuscated = bool(obfuscated)
+        return _intern(cls, (name, type, extra, obfuscated), name=name, type=type, extra=extra, obfuscated=obfuscated)
+
+    def __reduce__(self):
+        return self.__class__, (self.name, self.type, self.extra, self.obfuscated)
 
     def __str__(self):
         obfuscated_str = '?' if self.obfuscated else ""
@@ -45,20 +100,27 @@ class WildCard(NonTerminal):
         return "_".join(items)
 
     def __hash__(self):
-        return hash(self.__str__())
+        return self._hash
     def __eq__(self, other):
-        return isinstance(other, WildCard) and self.name == other.name and self.type == other.type and self.extra == other.extra and self.obfuscated == other.obfuscated
+        return self is other or (isinstance(other, WildCard) and self.name == other.name and self.type == other.type and self.extra == other.extra and self.obfuscated == other.obfuscated)
+
+
+class Anonymized(Immutable):
+    __slots__ = ("name", "_hash")
+
+    def __new__(cls, name):
+        name = str(name)
+        return _intern(cls, (name,), name=name)
 
+    def __reduce__(self):
+        return self.__class__, (self.name,)
 
-class Anonymized(object):
-    def __init__(self, name):
-        self.name = name
     def __str__(self):
         return "<{}>".format(self.name)
     def __hash__(self):
-        return hash(self.__str__())
+        return self._hash
     def __eq__(self, other):
-        return isinstance(other, Anonymized) and self.name == other.name
+        return self is other or (isinstance(other, Anonymized) and self.name == other.name)
 
 
 # The GPSR grammars all have this as their root
@@ -2,7 +2,7 @@ import itertools
 from collections import defaultdict
 
 from gpsr_command_understanding.tokens import WildCard, NonTerminal
-from lark import Token
+from lark import Token, Tree
 
 
 def merge_dicts(x, y):
@@ -39,6 +39,58 @@ def replace_child_in_tree(tree, child_target, replacement, only_once=False):
     return did_replace
 
 
+def replace_child_in_tree_copy(tree, child_target, replacement, only_once=False):
+    """
+    Makes the same replacements as replace_child_in_tree, but leaves the tree alone. Only the nodes on the way down to
+    a replacement are copied; everything else is shared with the original.
+    :return: the new tree, or the original if nothing matched
+    """
+    # Same visiting order as replace_child_in_tree, so only_once picks the same child
+    replaced = {}
+    for subtree in tree.iter_subtrees():
+        children = None
+        for i, child in enumerate(subtree.children):
+            if child == child_target:
+                if children is None:
+                    children = list(subtree.children)
+                children[i] = replacement
+                if only_once:
+                    break
+        if children is not None:
+            replaced[id(subtree)] = children
+            if only_once:
+                break
+    if not replaced:
+        return tree
+    return _rebuild(tree, replaced, {})
+
+
+def _rebuild(tree, replaced, memo):
+    # A node reachable along several paths gets exactly one copy, like it would from deepcopy
+    key = id(tree)
+    if key in memo:
+        return memo[key]
+    children = replaced.get(key)
+    for i, child in enumerate(tree.children):
+        if not isinstance(child, Tree) or (children is not None and children[i] is not child):
+            continue
+        new_child = _rebuild(child, replaced, memo)
+        if new_child is not child:
+            if children is None:
+                children = list(tree.children)
+            children[i] = new_child
+    result = tree if children is None else Tree(tree.data, children)
+    memo[key] = result
+    return result
+
+
+def copy_tree(tree):
+    """
+    Copies every node of the tree. Tokens are never modified in place, so the leaves are shared.
+    """
+    return Tree(tree.data, [copy_tree(child) if isinstance(child, Tree) else child for child in tree.children])
+
+
 def replace_words_in_tree(tree, replacement):
     for tree in tree.iter_subtrees():
         for i, child in enumerate(tree.children):
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Timing harness for the generation pipeline. Each subcommand measures one stage; run with -h to list them.
+"""
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import timeit
+import tracemalloc
+from copy import deepcopy
+from itertools import islice
+
+from gpsr_command_understanding.compiled_grammar import CompiledGrammar
+from gpsr_command_understanding.generator import Generator, get_generator
+from gpsr_command_understanding.generation import pairs_without_placeholders, generate_sentence_parse_pairs
+from gpsr_command_understanding.grammar import expand_shorthand
+from gpsr_command_understanding.loading_helpers import load_all_2018_by_cat
+from gpsr_command_understanding.tokens import ROOT_SYMBOL
+
+RESOURCES_DIR = os.path.abspath(os.path.dirname(__file__) + "/../resources")
+GRAMMAR_DIR_2018 = os.path.join(RESOURCES_DIR, "generator2018")
+
+
+def bench_startup(args):
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for semantic_form in ["lambda", "slot"]:
+            uncached = min(timeit.repeat(lambda: Generator(semantic_form_version=semantic_form, parser_cache_dir=""),
+                                         number=1, repeat=args.repeat))
+            # The first construction populates the cache
+            cold = timeit.timeit(lambda: Generator(semantic_form_version=semantic_form, parser_cache_dir=cache_dir),
+                                 number=1)
+            warm = min(timeit.repeat(lambda: Generator(semantic_form_version=semantic_form, parser_cache_dir=cache_dir),
+                                     number=1, repeat=args.repeat))
+            print("Generator({}) no cache {:.3f}s cold cache {:.3f}s warm cache {:.3f}s".format(semantic_form, uncached,
+                                                                                                cold, warm))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def bench_load(args):
+    generator = get_generator()
+    snapshot_dir = tempfile.mkdtemp()
+    try:
+        no_snapshot = min(timeit.repeat(lambda: load_all_2018_by_cat(generator, GRAMMAR_DIR_2018, snapshot_dir=""),
+                                        number=1, repeat=args.repeat))
+        cold = timeit.timeit(lambda: load_all_2018_by_cat(generator, GRAMMAR_DIR_2018, snapshot_dir=snapshot_dir),
+                             number=1)
+        warm = min(timeit.repeat(lambda: load_all_2018_by_cat(generator, GRAMMAR_DIR_2018, snapshot_dir=snapshot_dir),
+                                 number=1, repeat=args.repeat))
+        print("load_all_2018_by_cat no snapshot {:.3f}s cold snapshot {:.3f}s warm snapshot {:.3f}s".format(
+            no_snapshot, cold, warm))
+    finally:
+        shutil.rmtree(snapshot_dir)
+
+
+def bench_expand(args):
+    generator = get_generator()
+    total = 0.
+    for grammar_dir in ["generator2018", "generator2019"]:
+        for path in sorted(glob.glob(os.path.join(RESOURCES_DIR, grammar_dir, "*.txt"))):
+            if "slot" in os.path.basename(path):
+                continue
+            trees = []
+            with open(path, encoding="utf-8-sig") as f:
+                for line in f:
+                    line = line.strip()
+                    if "=" not in line:
+                        continue
+                    if "semantics" in path:
+                        # Only the utterance side of a semantics rule is parsed with the generator grammar
+                        tree = generator.generator_sequence_parser.parse(line.split("=")[0].strip())
+                    else:
+                        tree = generator.generator_grammar_parser.parse(line)
+                        tree = tree.children[1] if tree.children else None
+                    if tree and tree.children:
+                        trees.append(tree)
+            # expand_shorthand normalizes in place, so give every repetition fresh trees
+            inputs = [deepcopy(trees) for _ in range(args.repeat)]
+            elapsed = min(timeit.repeat(lambda: [expand_shorthand(tree) for tree in inputs.pop()], number=1,
+                                        repeat=args.repeat))
+            total += elapsed
+            print("{}/{} {} rules {:.4f}s".format(grammar_dir, os.path.basename(path), len(trees), elapsed))
+    print("total {:.4f}s".format(total))
+
+
+def bench_generate(args):
+    categories = load_all_2018_by_cat(get_generator(), GRAMMAR_DIR_2018)
+    total = 0.
+    for i, (_, rules_anon, _, semantics) in enumerate(categories):
+        elapsed = min(timeit.repeat(lambda: pairs_without_placeholders(rules_anon, semantics), number=1,
+                                    repeat=args.repeat))
+        total += elapsed
+        print("cat{} pairs_without_placeholders {:.3f}s".format(i + 1, elapsed))
+    print("total {:.3f}s".format(total))
+
+
+def bench_tokens(args):
+    # The membership test generation runs over every leaf of every partial derivation
+    rules_anon = load_all_2018_by_cat(get_generator(), GRAMMAR_DIR_2018)[2][1]
+    leaves = [leaf for productions in rules_anon.values() for production in productions
+              for leaf in production.scan_values(lambda x: True)]
+    elapsed = min(timeit.repeat(lambda: [leaf in rules_anon.keys() for leaf in leaves], number=100,
+                                repeat=args.repeat))
+    print("{} rule lookups x100 {:.3f}s".format(len(leaves), elapsed))
+    trees = [production for productions in rules_anon.values() for production in productions]
+    elapsed = min(timeit.repeat(lambda: deepcopy(trees), number=10, repeat=args.repeat))
+    print("deepcopy of {} productions x10 {:.3f}s".format(len(trees), elapsed))
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_compiled(args):
+    categories = load_all_2018_by_cat(get_generator(), GRAMMAR_DIR_2018)
+    for i, (_, _, rules_ground, semantics) in enumerate(categories):
+        compiled = CompiledGrammar(rules_ground, semantics)
+        trees = lambda: list(islice(generate_sentence_parse_pairs(ROOT_SYMBOL, rules_ground, semantics), args.limit))
+        ids = lambda: list(islice(compiled.generate_sentence_parse_pairs(ROOT_SYMBOL), args.limit))
+        tree_time = min(timeit.repeat(trees, number=1, repeat=args.repeat))
+        compile_time = min(timeit.repeat(lambda: CompiledGrammar(rules_ground, semantics), number=1,
+                                         repeat=args.repeat))
+        id_time = min(timeit.repeat(ids, number=1, repeat=args.repeat))
+        print("cat{} first {} grounded pairs: trees {:.3f}s {:.1f}MB peak, compiled {:.3f}s (+{:.3f}s to compile) "
+              "{:.1f}MB peak".format(i + 1, args.limit, tree_time, peak_memory(trees) / 2 ** 20, id_time, compile_time,
+                                     peak_memory(ids) / 2 ** 20))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--repeat", default=5, type=int)
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+    subparsers.add_parser("startup").set_defaults(func=bench_startup)
+    subparsers.add_parser("load").set_defaults(func=bench_load)
+    subparsers.add_parser("expand").set_defaults(func=bench_expand)
+    subparsers.add_parser("generate").set_defaults(func=bench_generate)
+    subparsers.add_parser("tokens").set_defaults(func=bench_tokens)
+    compiled_parser = subparsers.add_parser("compiled")
+    compiled_parser.add_argument("-n", "--limit", default=2000, type=int)
+    compiled_parser.set_defaults(func=bench_compiled)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,54 @@
 # coding: utf-8
+import collections
+import copy
+import glob
+import itertools
+import json
 import os
+import pickle
+import random
+import shutil
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-from gpsr_command_understanding.generation import generate_sentence_parse_pairs
-from gpsr_command_understanding.generator import Generator
-from gpsr_command_understanding.grammar import NonTerminal, tree_printer, expand_shorthand
-from gpsr_command_understanding.loading_helpers import load_all_2018_by_cat, load_all_2019
+from lark import Tree
+
+from gpsr_command_understanding.compiled_grammar import CompiledGrammar
+from gpsr_command_understanding.generation import generate_sentence_parse_pairs, generate_sentence_slot_pairs, \
+    generate_sentences, generate_uniform_pairs, expand_all_semantics, expand_pair, ExpansionCache, \
+    generate_sentences_sharded, pairs_without_placeholders, profile_generation
+from gpsr_command_understanding.generator import Generator, get_generator, get_lambda_parser, \
+    get_grounding_per_each_parse_by_cat
+from gpsr_command_understanding.grammar import NonTerminal, tree_printer, expand_shorthand, DiscardVoid, \
+    CombineExpressions, normalize_expressions, render, render_all
+from gpsr_command_understanding.loading_helpers import load_all_2018_by_cat, load_all_2019, load_entities_from_xml
 from gpsr_command_understanding.parser import GrammarBasedParser
+from gpsr_command_understanding.semantics import SemanticsRules
+from gpsr_command_understanding.tokens import WildCard, Anonymized
+from gpsr_command_understanding.util import get_placeholders, replace_child_in_tree, replace_child_in_tree_copy
 
 GRAMMAR_DIR_2018 = os.path.abspath(os.path.dirname(__file__) + "/../resources/generator2018")
 GRAMMAR_DIR_2019 = os.path.abspath(os.path.dirname(__file__) + "/../resources/generator2019")
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
 class TestGenerator(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls) -> None:
+        # Loading the 2018 grammar dominates the suite, so do it once. Tests treat these as read-only
+        with mock.patch.dict(os.environ, {"GPSR_PARSER_CACHE_DIR": ""}):
+            generator = get_generator(grammar_format_version=2018)
+            cls.categories_2018 = load_all_2018_by_cat(generator, GRAMMAR_DIR_2018, snapshot_dir="")
+            cls.lazy_categories_2018 = load_all_2018_by_cat(generator, GRAMMAR_DIR_2018, expand_shorthand=False,
+                                                            snapshot_dir="")
+
     def setUp(self) -> None:
-        self.generator = Generator(grammar_format_version=2019)
+        # Never read or write the user's parser and snapshot caches. Tests that want them pass their own directories
+        environ = mock.patch.dict(os.environ, {"GPSR_PARSER_CACHE_DIR": "", "GPSR_SNAPSHOT_CACHE_DIR": ""})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.generator = get_generator(grammar_format_version=2019)
 
     def test_parse_rule(self):
         rules = {}
@@ -31,6 +65,25 @@ class TestGenerator(unittest.TestCase):
         test = self.generator.lambda_parser.parse("# test")
 
 
+    def test_parser_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cold = Generator(grammar_format_version=2018, parser_cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+            warm = Generator(grammar_format_version=2018, parser_cache_dir=cache_dir)
+            rule = "$test = {pron} went to the (mall | store) and {location} $go"
+            self.assertEqual(cold.generator_grammar_parser.parse(rule), warm.generator_grammar_parser.parse(rule))
+            self.assertEqual(cold.lambda_parser.parse("(go {location})"), warm.lambda_parser.parse("(go {location})"))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_shared_generator(self):
+        self.assertIs(get_generator(grammar_format_version=2019), self.generator)
+        self.assertIsNot(get_generator(grammar_format_version=2019, semantic_form_version="slot"), self.generator)
+        self.assertIs(get_lambda_parser(), get_generator().lambda_parser)
+        with self.assertRaises(RuntimeError):
+            self.generator.load_set_of_rules([], [], None, None, None, None)
+
     def test_parse_basic(self):
         test = self.generator.generator_grammar_parser.parse("$test = {pron} went to the mall and {location} $go $home")
         print(test.pretty())
@@ -51,6 +104,14 @@ class TestGenerator(unittest.TestCase):
         result = expand_shorthand(test)
         self.assertEqual(len(result), 3)
 
+        test = self.generator.generator_grammar_parser.parse("$test = (a | b) went (c | d) to the store")
+        store = test.children[1].children[-1]
+        result = expand_shorthand(test.children[1])
+        self.assertEqual(["b went d to the store", "b went c to the store", "a went d to the store",
+                          "a went c to the store"], [tree_printer(x) for x in result])
+        # Parts of the rule that don't involve a choice aren't copied
+        self.assertTrue(all(any(child is store for child in x.children) for x in result))
+
     def test_parse_choice(self):
         test = self.generator.generator_grammar_parser.parse("$test = ( oneword | two words)")
         print(test.pretty())
@@ -70,14 +131,358 @@ class TestGenerator(unittest.TestCase):
         print(tree_printer(complex_choice))
 
     def test_generate(self):
-        generator = Generator(grammar_format_version=2018)
+        generator = get_generator(grammar_format_version=2018)
         grammar = generator.load_rules(os.path.join(FIXTURE_DIR, "grammar.txt"))
         semantics = generator.load_semantics_rules(os.path.join(FIXTURE_DIR, "semantics.txt"))
         pairs = list(generate_sentence_parse_pairs(NonTerminal("Main"),grammar, semantics))
         self.assertEqual(len(pairs), 6)
 
-    def test_load_2018(self):
+    def test_generate_lazy_choices(self):
+        generator = get_generator(grammar_format_version=2018)
+        grammar_path = os.path.join(FIXTURE_DIR, "grammar.txt")
+        eager = generator.load_rules(grammar_path)
+        lazy = generator.load_rules(grammar_path, expand_shorthand=False)
+        self.assertLess(sum(map(len, lazy.values())), sum(map(len, eager.values())))
+        self.assertEqual(set(map(tree_printer, generate_sentences(NonTerminal("Main"), lazy))),
+                         set(map(tree_printer, generate_sentences(NonTerminal("Main"), eager))))
+
+        semantics = generator.load_semantics_rules(os.path.join(FIXTURE_DIR, "semantics.txt"))
+        eager_pairs = [(tree_printer(u), tree_printer(p)) for u, p in generate_sentence_parse_pairs(NonTerminal("Main"), eager, semantics)]
+        lazy_pairs = [(tree_printer(u), tree_printer(p)) for u, p in generate_sentence_parse_pairs(NonTerminal("Main"), lazy, semantics)]
+        self.assertEqual(sorted(lazy_pairs), sorted(eager_pairs))
+
+    def test_traversal_order(self):
+        rules, _, _, semantics = self.categories_2018[0]
+        pairs = {}
+        for order in ["bfs", "dfs", "iddfs"]:
+            pairs[order] = [(tree_printer(u), tree_printer(p)) for u, p in generate_sentence_parse_pairs(NonTerminal("Main"), rules, semantics, order=order)]
+        self.assertEqual(pairs["iddfs"], pairs["bfs"])
+        self.assertEqual(sorted(pairs["dfs"]), sorted(pairs["bfs"]))
+        self.assertEqual(len(list(generate_sentence_parse_pairs(NonTerminal("Main"), rules, semantics, order="dfs", max_frontier=20))), len(pairs["bfs"]))
+        with self.assertRaises(RuntimeError):
+            list(generate_sentence_parse_pairs(NonTerminal("Main"), rules, semantics, max_frontier=20))
+
+    def test_random_depth_first(self):
+        rules = {NonTerminal("Main"): [Tree("expression", [NonTerminal("A"), NonTerminal("A")])],
+                 NonTerminal("A"): [Tree("expression", [letter]) for letter in "abcdef"]}
+        for generate in [generate_sentence_parse_pairs, generate_sentence_slot_pairs]:
+            for seed in range(5):
+                sentences = [render(u) for u, _ in generate(NonTerminal("Main"), rules, {}, yield_requires_semantics=False,
+                                                            random_generator=random.Random(seed), order="dfs")]
+                self.assertEqual(len(sentences), 36)
+                self.assertEqual(len(set(sentences)), 36)
+        self.assertEqual([render(p) for p in rules[NonTerminal("A")]], list("abcdef"))
+
+    def test_expansion_cache(self):
+        categories = self.categories_2018
+        cache = ExpansionCache()
+        list(generate_sentences(NonTerminal("Main"), categories[0][1], expansion_cache=cache))
+        cached = len(cache.expansions)
+        self.assertGreater(cached, 0)
+        # Nonterminals from common_rules.txt are already there for the next category
+        list(generate_sentences(NonTerminal("vbgopl"), categories[1][1], expansion_cache=cache))
+        self.assertEqual(len(cache.expansions), cached)
+
+        rules = copy.deepcopy(categories[0][1])
+        rules[NonTerminal("vbgopl")] = [Tree("expression", ["scoot"])]
+        sentences = set(map(tree_printer, generate_sentences(NonTerminal("Main"), rules, expansion_cache=cache)))
+        self.assertTrue(any("scoot" in sentence for sentence in sentences))
+
+        with self.assertRaises(ValueError):
+            list(generate_sentences(NonTerminal("a"), {NonTerminal("a"): [Tree("expression", ["x", NonTerminal("a")])]}, expansion_cache=cache))
+
+        # A small cache evicts instead of growing, and still gives the same sentences
+        small_cache = ExpansionCache(total_limit=50)
+        expected = list(generate_sentences(NonTerminal("Main"), categories[0][1], expansion_cache=ExpansionCache()))
+        self.assertEqual(list(generate_sentences(NonTerminal("Main"), categories[0][1], expansion_cache=small_cache)), expected)
+        self.assertLessEqual(small_cache.size, 50)
+        self.assertEqual(small_cache.size, sum(map(len, small_cache.expansions.values())))
+
+    def test_sharded_enumeration(self):
+        _, rules, _, semantics = self.categories_2018[0]
+        sentences = list(dict.fromkeys(generate_sentences(NonTerminal("Main"), rules)))
+        self.assertEqual(generate_sentences_sharded(NonTerminal("Main"), rules, processes=2), sentences)
+        sequential = pairs_without_placeholders(rules, semantics)
+        parallel = pairs_without_placeholders(rules, semantics, processes=2)
+        self.assertEqual(list(sequential.items()), list(parallel.items()))
+        # The sequential path keeps no module state, so calls can overlap
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            threaded = list(pool.map(lambda _: pairs_without_placeholders(rules, semantics), range(3)))
+        self.assertTrue(all(list(pairs.items()) == list(sequential.items()) for pairs in threaded))
+
+    def test_placeholder_worklist(self):
+        _, rules_anon, _, semantics = self.categories_2018[0]
+        # expand_pair on its own rescans every sentence it's given
+        scanned = []
+        frontier = collections.deque([Tree("expression", [NonTerminal("Main")])])
+        while frontier:
+            sentence = frontier.popleft()
+            expansions = [expanded for expanded, _ in expand_pair(sentence, None, rules_anon)]
+            if not expansions:
+                scanned.append(tree_printer(sentence))
+            frontier.extend(expansions)
+        tracked = [tree_printer(sentence) for sentence, _ in
+                   generate_sentence_parse_pairs(NonTerminal("Main"), rules_anon, semantics, yield_requires_semantics=False)]
+        self.assertEqual(tracked, scanned)
+
+    def test_render(self):
+        _, rules_anon, rules_ground, semantics = self.categories_2018[0]
+        trees = [tree for pair in expand_all_semantics(rules_anon, semantics) for tree in pair]
+        trees += [tree for pair in itertools.islice(generate_sentence_parse_pairs(NonTerminal("Main"), rules_ground, semantics), 500) for tree in pair]
+        trees += [production for productions in rules_anon.values() for production in productions]
+        self.assertEqual(render_all(trees), [tree_printer(tree) for tree in trees])
+        lazy = self.generator.generator_grammar_parser.parse("$test = (a | b c) $d {object}")
+        self.assertEqual(render(lazy), tree_printer(lazy))
+
+    def test_copy_on_write_expansion(self):
+        rules, _, _, semantics = self.categories_2018[0]
+        for utterance, parse in list(semantics.items())[:10]:
+            before = (copy.deepcopy(utterance), copy.deepcopy(parse))
+            for token in get_placeholders(utterance):
+                expected = copy.deepcopy(parse)
+                replace_child_in_tree(expected, token, Tree("expression", ["x"]))
+                self.assertEqual(replace_child_in_tree_copy(parse, token, Tree("expression", ["x"])), expected)
+            # Expanding shares structure with the inputs but never changes them
+            list(expand_pair(utterance, parse, rules))
+            self.assertEqual((utterance, parse), before)
+
+        tree = Tree("expression", [WildCard("void"), Tree("expression", ["a", Anonymized("void")]), Tree("predicate", ["b", Tree("expression", ["c", Tree("expression", ["d"])])])])
+        expected = copy.deepcopy(tree)
+        DiscardVoid().visit(expected)
+        CombineExpressions().visit(expected)
+        original = copy.deepcopy(tree)
+        self.assertEqual(normalize_expressions(tree), expected)
+        self.assertEqual(tree, original)
+
+    def test_normalize_expressions(self):
+        trees = []
+        for expand, categories_2018 in ((True, self.categories_2018), (False, self.lazy_categories_2018)):
+            categories = categories_2018 + [load_all_2019(self.generator, GRAMMAR_DIR_2019, expand_shorthand=expand)[:4]]
+            for rules, rules_anon, rules_ground, semantics in categories:
+                for rule_set in (rules, rules_anon, rules_ground):
+                    trees += [production for productions in rule_set.values() for production in productions]
+                trees += list(semantics.keys()) + list(semantics.values())
+                trees += [tree for pair in itertools.islice(expand_all_semantics(rules_anon, semantics), 200) for tree in pair]
+        # Nest some to make sure fragments get spliced all the way up
+        trees += [Tree("expression", [tree, "x", Tree("expression", [WildCard("void"), tree])]) for tree in trees[:500]]
+        for tree in trees:
+            expected = copy.deepcopy(tree)
+            DiscardVoid().visit(expected)
+            CombineExpressions().visit(expected)
+            self.assertEqual(normalize_expressions(tree), expected)
+
+    def test_compiled_grammar(self):
+        for rules, rules_anon, _, semantics in self.categories_2018[:2]:
+            for production_rules in [rules, rules_anon]:
+                expected = [(tree_printer(u), tree_printer(p)) for u, p in generate_sentence_parse_pairs(NonTerminal("Main"), production_rules, semantics)]
+                compiled = CompiledGrammar(production_rules, semantics)
+                pairs = list(compiled.generate_sentence_parse_pairs(NonTerminal("Main")))
+                self.assertEqual([(tree_printer(u), tree_printer(p)) for u, p in pairs], expected)
+
+    def test_recognizes(self):
+        for categories in (self.categories_2018, self.lazy_categories_2018):
+            _, rules_anon, _, semantics = categories[1]
+            language = set(generate_sentences(NonTerminal("Main"), rules_anon))
+            candidates = [utterance for utterance, _ in expand_all_semantics(rules_anon, semantics)]
+            candidates += [Tree("expression", sentence.children[:-1]) for sentence in list(language)[:100]]
+            candidates += [Tree("expression", ["unheard", "of"])]
+            compiled = CompiledGrammar(rules_anon)
+            self.assertEqual([compiled.recognizes(candidate, NonTerminal("Main")) for candidate in candidates],
+                             [candidate in language for candidate in candidates])
+            self.assertTrue(all(compiled.recognizes(sentence, NonTerminal("Main")) for sentence in language))
+
+    def test_derivation_counts(self):
+        for rules, rules_anon, _, semantics in self.categories_2018:
+            compiled = CompiledGrammar(rules_anon, semantics)
+            self.assertEqual(compiled.count_derivations(NonTerminal("Main")), len(list(generate_sentences(NonTerminal("Main"), rules_anon))))
+            for utterance, count in compiled.semantics_counts().items():
+                self.assertEqual(count, len(list(generate_sentences(utterance, rules_anon))))
+
+        recursive = {NonTerminal("a"): [Tree("expression", ["x", NonTerminal("b")])],
+                     NonTerminal("b"): [Tree("expression", [NonTerminal("a")])]}
+        with self.assertRaises(ValueError):
+            CompiledGrammar(recursive).count_derivations(NonTerminal("a"))
+
+        # Recursion that the counted symbol can't reach doesn't matter to it
+        rules = dict(recursive)
+        rules[NonTerminal("Main")] = [Tree("expression", ["hello", NonTerminal("c")])]
+        rules[NonTerminal("c")] = [Tree("expression", ["x"]), Tree("expression", ["y"])]
+        compiled = CompiledGrammar(rules)
+        self.assertEqual(compiled.count_derivations(NonTerminal("Main")), 2)
+        # Queries never add symbols. Unknown ones can't be expanded, and can't start anything
+        symbols = len(compiled.symbols)
+        self.assertEqual(compiled.count_derivations(["hello", NonTerminal("B")]), 1)
+        self.assertFalse(compiled.recognizes(["hello", "x"], NonTerminal("Other")))
+        self.assertEqual(compiled.count_derivations(NonTerminal("Other")), 1)
+        self.assertEqual(len(compiled.symbols), symbols)
+        self.assertTrue(compiled.recognizes(["hello", "x"], NonTerminal("Main")))
+
+    def test_generate_uniform_pairs(self):
+        _, rules_anon, _, semantics = self.categories_2018[1]
+        all_pairs = set((tree_printer(u), tree_printer(p)) for u, p in expand_all_semantics(rules_anon, semantics))
+        samples = generate_uniform_pairs(rules_anon, semantics, random_generator=random.Random(0))
+        counts = collections.Counter((tree_printer(u), tree_printer(p)) for u, p in itertools.islice(samples, 5 * len(all_pairs)))
+        self.assertTrue(set(counts.keys()).issubset(all_pairs))
+        # Every pair is equally likely, so none should be wildly over-represented
+        self.assertLess(max(counts.values()), 20)
+
+    def test_pair_at(self):
+        generator = Generator(grammar_format_version=2018)
+        categories = self.categories_2018
+        _, rules_anon, _, semantics = categories[0]
+        compiled = CompiledGrammar(rules_anon, semantics)
+        unranked = collections.Counter()
+        for i in range(compiled.pair_count()):
+            utterance, parse = compiled.pair_at(i)
+            unranked[(tree_printer(utterance), tree_printer(parse))] += 1
+        expanded = collections.Counter((tree_printer(u), tree_printer(p)) for u, p in expand_all_semantics(rules_anon, semantics))
+        self.assertEqual(unranked, expanded)
+
+        generator.rules.extend(categories[:2])
+        count = generator.count([1, 2])
+        self.assertEqual(count, sum(CompiledGrammar(rules_ground, semantics).pair_count()
+                                    for _, _, rules_ground, semantics in categories[:2]))
+        self.assertEqual(generator.pair_at(count - 1, [1, 2]), generator.get_compiled_rule_set(2).pair_at(
+            generator.count([2]) - 1))
+        self.assertRaises(IndexError, generator.pair_at, count, [1, 2])
+        slot_generator = Generator(grammar_format_version=2018, semantic_form_version="slot")
+        slot_generator.rules.extend(categories[:1])
+        self.assertRaises(ValueError, slot_generator.pair_at, 0, [1])
+
+    def test_generation_budgets(self):
+        generator = Generator(grammar_format_version=2018)
+        categories = self.categories_2018
+        _, _, rules_ground, semantics = categories[1]
+        pairs = list(generate_sentence_parse_pairs(NonTerminal("Main"), rules_ground, semantics, max_pairs=50))
+        self.assertEqual(len(pairs), 50)
+        self.assertEqual(pairs, list(itertools.islice(generate_sentence_parse_pairs(NonTerminal("Main"), rules_ground, semantics), 50)))
+
+        # The grounded language has millions of sentences, so only the time limit can end this. The clock advances a
+        # second each time it's read: once to set the deadline, then once per expansion until it passes
+        with mock.patch("time.monotonic", side_effect=itertools.count()) as clock:
+            list(generate_sentence_parse_pairs(NonTerminal("Main"), rules_ground, semantics, time_limit=100.5))
+        self.assertEqual(clock.call_count, 102)
+
+        calls = []
+        cancel = lambda: calls.append(None) or len(calls) > 100
+        list(generate_sentence_slot_pairs(NonTerminal("Main"), rules_ground, semantics, cancel=cancel))
+        self.assertEqual(len(calls), 101)
+
+        generator.rules.extend(categories[:2])
+        all_pairs = generator.get_utterance_semantics_pairs(random.Random(0), [1, 2], branch_cap=1, max_pairs=10)
+        self.assertLessEqual(len(all_pairs), 20)
+
+    def test_generation_profile(self):
+        _, rules_anon, rules_ground, semantics = self.categories_2018[0]
+        with profile_generation() as profile:
+            pairs = list(expand_all_semantics(rules_anon, semantics))
+        self.assertTrue(profile.nonterminals)
+        self.assertTrue(all(stats["expansions"] > 0 for stats in profile.nonterminals.values()))
+        self.assertEqual(sum(stats["pairs"] for stats in profile.starts.values()), len(pairs))
+        self.assertEqual(json.loads(profile.to_json()), profile.as_dict())
+        report = profile.report(limit=5)
+        self.assertIn("nonterminal", report)
+        self.assertIn("start", report)
+
+        # Nothing is recorded once the block exits
+        list(expand_all_semantics(rules_anon, semantics))
+        self.assertEqual(sum(stats["pairs"] for stats in profile.starts.values()), len(pairs))
+
+        # Generators started in the block record into its profile, wherever they're consumed
+        with profile_generation() as profile:
+            pending = generate_sentence_parse_pairs(NonTerminal("Main"), rules_anon, semantics)
+            pending_slots = generate_sentence_slot_pairs(NonTerminal("Main"), rules_ground, semantics, max_pairs=50)
+        self.assertFalse(profile.starts)
+        parse_pairs = list(pending)
+        self.assertEqual(sum(stats["pairs"] for stats in profile.starts.values()), len(parse_pairs))
+        list(pending_slots)
+        self.assertEqual(sum(stats["pairs"] for stats in profile.starts.values()), len(parse_pairs) + 50)
+        self.assertTrue(profile.nonterminals)
+
+        # Copies made while making lazy choices and substituting slot semantics are counted too
+        _, lazy_anon, _, _ = self.lazy_categories_2018[0]
+        with profile_generation() as profile:
+            list(expand_all_semantics(lazy_anon, semantics))
+            slot_pairs = list(generate_sentence_slot_pairs(NonTerminal("Main"), rules_ground, semantics, max_pairs=50))
+        self.assertGreater(profile.nonterminals["(choice)"]["copies"], 0)
+        self.assertGreaterEqual(sum(stats["copies"] for name, stats in profile.nonterminals.items() if name != "(choice)"),
+                                len(slot_pairs))
+
+    def test_grounding_reuses_wild_expansions(self):
+        categories = self.categories_2018[:1]
+        parses = lambda groundings: {parse for _, parse, _ in groundings[0]}
+        uncached = get_grounding_per_each_parse_by_cat(categories, random.Random(0))
+        wild_cache = {}
+        cached = get_grounding_per_each_parse_by_cat(categories, random.Random(0), wild_cache)
+        self.assertEqual(parses(cached), parses(uncached))
+        self.assertEqual(len(wild_cache), len(categories[0][3]))
+
+        # Later passes only reground, so they cover the same parses
+        regrounded = get_grounding_per_each_parse_by_cat(categories, random.Random(1), wild_cache)
+        self.assertEqual(parses(regrounded), parses(cached))
+
+        # Different rules at the same index don't reuse the first category's expansions
+        other = self.categories_2018[1:2]
+        self.assertEqual(parses(get_grounding_per_each_parse_by_cat(other, random.Random(0), wild_cache)),
+                         parses(get_grounding_per_each_parse_by_cat(other, random.Random(0))))
+
+    def test_tokens_interned(self):
+        self.assertIs(NonTerminal("Main"), NonTerminal("Main"))
+        self.assertIs(WildCard("location", " room ", "1"), WildCard("location", "room", "1"))
+        self.assertIsNot(WildCard("object"), WildCard("object", obfuscated=True))
+        self.assertNotEqual(WildCard("object"), WildCard("object", obfuscated=True))
+        for token in [NonTerminal("Main"), WildCard("object", "known"), Anonymized("object")]:
+            self.assertIs(pickle.loads(pickle.dumps(token)), token)
+            self.assertIs(copy.deepcopy(token), token)
+            with self.assertRaises(AttributeError):
+                token.name = "changed"
+
+    def test_semantics_index(self):
+        generator = get_generator(grammar_format_version=2018)
+        semantics = generator.load_semantics_rules(os.path.join(FIXTURE_DIR, "semantics.txt"))
+        self.assertIsInstance(semantics, SemanticsRules)
+        self.assertEqual(len(semantics.by_signature), len(semantics))
+        for utterance, parse in semantics.items():
+            self.assertIs(semantics.lookup(utterance), parse)
+        self.assertIsNone(semantics.lookup(Tree("expression", [NonTerminal("nothing")])))
+        # The index has to survive the copies made by snapshots and parallel loading
+        restored = pickle.loads(pickle.dumps(semantics))
+        self.assertEqual(restored, semantics)
+        self.assertEqual(restored.by_signature, semantics.by_signature)
+
+        # Every way of changing the rules keeps the index in step
+        rules = SemanticsRules()
+        first, second = list(semantics.items())[:2]
+        self.assertIs(rules.setdefault(*first), first[1])
+        self.assertIs(rules.lookup(first[0]), first[1])
+        rules |= {first[0]: second[1]}
+        self.assertIs(rules.lookup(first[0]), second[1])
+        self.assertIs(rules.pop(first[0]), second[1])
+        self.assertIsNone(rules.lookup(first[0]))
+        self.assertIsNone(rules.pop(first[0], None))
+        rules[second[0]] = second[1]
+        self.assertEqual(rules.popitem(), second)
+        self.assertIsNone(rules.lookup(second[0]))
+        rules.update([first, second])
+        rules.clear()
+        self.assertIsNone(rules.lookup(first[0]))
+        self.assertEqual(rules.by_signature, {})
+
+    def test_load_rules_memoized(self):
         generator = Generator(grammar_format_version=2018)
+        grammar_path = os.path.join(FIXTURE_DIR, "grammar.txt")
+        first = generator.load_rules(grammar_path)
+        parsed = generator.load_rule_file(grammar_path)
+        self.assertIs(generator.load_rule_file(grammar_path), parsed)
+        # Callers get their own production lists, but share the trees in them
+        first[NonTerminal("when")].clear()
+        second = generator.load_rules(grammar_path)
+        self.assertNotEqual(first, second)
+        self.assertIs(second[NonTerminal("when")][0], dict(parsed)[NonTerminal("when")][0])
+        self.assertEqual(second, Generator(grammar_format_version=2018).load_rules(grammar_path))
+
+    def test_load_2018(self):
+        generator = get_generator(grammar_format_version=2018)
         all_2018= load_all_2018_by_cat(generator, GRAMMAR_DIR_2018, expand_shorthand=False)
         # To manually inspect correctness for now...
         """for nonterm, rules in all_2018[0].items():
@@ -87,8 +492,49 @@ class TestGenerator(unittest.TestCase):
                 print(rule.pretty())
             print("---")"""
 
+    def test_load_2018_snapshot(self):
+        generator = get_generator(grammar_format_version=2018)
+        snapshot_dir = tempfile.mkdtemp()
+        grammar_dir = os.path.join(snapshot_dir, "generator2018")
+        shutil.copytree(GRAMMAR_DIR_2018, grammar_dir)
+        try:
+            fresh = load_all_2018_by_cat(generator, grammar_dir, snapshot_dir=snapshot_dir)
+            from_snapshot = load_all_2018_by_cat(generator, grammar_dir, snapshot_dir=snapshot_dir)
+            self.assertEqual(fresh, from_snapshot)
+            self.assertEqual(len(glob.glob(os.path.join(snapshot_dir, "*.pickle"))), 1)
+            # Any edit to a source file has to invalidate the snapshot
+            with open(os.path.join(grammar_dir, "common_rules.txt"), "a") as f:
+                f.write("\n$vbgo = wander\n")
+            edited = load_all_2018_by_cat(generator, grammar_dir, snapshot_dir=snapshot_dir)
+            self.assertEqual(len(glob.glob(os.path.join(snapshot_dir, "*.pickle"))), 2)
+            self.assertNotEqual(edited[0][0], fresh[0][0])
+            # So does any change to the code that did the loading
+            with mock.patch("gpsr_command_understanding.loading_helpers.get_source_code_hash", return_value="edited"):
+                load_all_2018_by_cat(generator, grammar_dir, snapshot_dir=snapshot_dir)
+            self.assertEqual(len(glob.glob(os.path.join(snapshot_dir, "*.pickle"))), 3)
+        finally:
+            shutil.rmtree(snapshot_dir)
+
+    def test_load_entities_once(self):
+        generator = get_generator(grammar_format_version=2018)
+        with mock.patch("gpsr_command_understanding.loading_helpers.load_entities_from_xml",
+                        wraps=load_entities_from_xml) as load_entities:
+            load_all_2018_by_cat(generator, GRAMMAR_DIR_2018, snapshot_dir="")
+            self.assertEqual(load_entities.call_count, 1)
+            load_all_2019(get_generator(grammar_format_version=2019), GRAMMAR_DIR_2019)
+            self.assertEqual(load_entities.call_count, 2)
+
+    def test_load_2019_parallel(self):
+        generator = get_generator(grammar_format_version=2019)
+        sequential = load_all_2019(generator, GRAMMAR_DIR_2019)
+        parallel = load_all_2019(generator, GRAMMAR_DIR_2019, processes=2)
+        self.assertEqual(sequential, parallel)
+        # Seeded generation depends on rule order, not just content
+        for sequential_rules, parallel_rules in zip(sequential[:3], parallel[:3]):
+            self.assertEqual(list(sequential_rules.keys()), list(parallel_rules.keys()))
+
     def test_load_2019(self):
-        generator = Generator(grammar_format_version=2019)
+        generator = get_generator(grammar_format_version=2019)
         all_2019 = load_all_2019(generator, GRAMMAR_DIR_2019, expand_shorthand=False)
 
         # To manually inspect correctness for now...
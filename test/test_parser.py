@@ -7,7 +7,7 @@ import unittest
 from lark import exceptions
 
 from gpsr_command_understanding.generation import generate_sentences, generate_sentence_parse_pairs
-from gpsr_command_understanding.generator import Generator
+from gpsr_command_understanding.generator import get_generator
 from gpsr_command_understanding.grammar import tree_printer
 from gpsr_command_understanding.loading_helpers import load_all_2019, \
     load_all_2018, load_entities_from_xml
@@ -21,7 +21,7 @@ class TestParsers(unittest.TestCase):
 
     def test_parse_utterance(self):
         rules = {}
-        generator = Generator(grammar_format_version=2019)
+        generator = get_generator(grammar_format_version=2019)
         grammar = generator.load_rules(os.path.join(FIXTURE_DIR, "grammar.txt"), expand_shorthand=False)
         parser = GrammarBasedParser(grammar)
         test = parser("say hi to him right now please")
@@ -30,7 +30,7 @@ class TestParsers(unittest.TestCase):
         print(test.pretty())
 
     def test_parse_all_of_2018(self):
-        generator = Generator(grammar_format_version=2018)
+        generator = get_generator(grammar_format_version=2018)
 
         grammar_dir = os.path.abspath(os.path.dirname(__file__) + "/../resources/generator2018")
         rules, rules_anon, _, _, _ = load_all_2018(generator, grammar_dir)
@@ -49,7 +49,7 @@ class TestParsers(unittest.TestCase):
         self.assertEqual(len(sentences), succeeded)
 
     def test_parse_all_of_2019(self):
-        generator = Generator(grammar_format_version=2018)
+        generator = get_generator(grammar_format_version=2018)
 
         grammar_dir = os.path.abspath(os.path.dirname(__file__) + "/../resources/generator2019")
         rules, rules_anon, _, _, _ = load_all_2019(generator, grammar_dir)
@@ -66,7 +66,7 @@ class TestParsers(unittest.TestCase):
         self.assertEqual(len(sentences), succeeded)
 
     def test_nearest_neighbor_parser(self):
-        generator = Generator(grammar_format_version=2018)
+        generator = get_generator(grammar_format_version=2018)
         rules = load_all_2019(generator, GRAMMAR_DIR)
 
         sentences = generate_sentences(ROOT_SYMBOL, rules[0])
@@ -97,7 +97,7 @@ class TestParsers(unittest.TestCase):
             "Bring the <object 1> from the <room 1> and put it next to the other <object 2> in the <room 2>")
 
     def test_parse_all_2019_anonymized(self):
-        generator = Generator(grammar_format_version=2019)
+        generator = get_generator(grammar_format_version=2019)
 
         grammar_dir = os.path.abspath(os.path.dirname(__file__) + "/../resources/generator2019")
         rules, rules_anon, rules_ground, semantics, entities = load_all_2019(generator, grammar_dir)